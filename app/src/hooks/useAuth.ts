@@ -1,4 +1,5 @@
 import { useState, useCallback } from 'react';
+import { AUTH_KEY, loadStoredAuth, saveStoredAuth, revokeRefreshToken } from '@/services/authToken';
 
 // 后端 API 地址 — 统一使用绝对地址，兼容网页/iOS/安卓
 const API_BASE_URL = 'http://106.14.148.230:8000/api';
@@ -6,6 +7,7 @@ const API_BASE_URL = 'http://106.14.148.230:8000/api';
 export interface AuthUser {
   email: string;
   token: string;
+  refreshToken?: string;
 }
 
 interface AuthState {
@@ -13,18 +15,11 @@ interface AuthState {
   isAuthenticated: boolean;
 }
 
-const AUTH_KEY = 'cloud-auth';
-
 function loadAuth(): AuthState {
-  try {
-    const raw = localStorage.getItem(AUTH_KEY);
-    if (raw) {
-      const user = JSON.parse(raw) as AuthUser;
-      if (user.token) {
-        return { user, isAuthenticated: true };
-      }
-    }
-  } catch { /* ignore */ }
+  const user = loadStoredAuth();
+  if (user?.token) {
+    return { user, isAuthenticated: true };
+  }
   return { user: null, isAuthenticated: false };
 }
 
@@ -36,7 +31,7 @@ export function useAuth() {
       const resp = await fetch(`${API_BASE_URL}/login`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ email, password }),
+        body: JSON.stringify({ email, password, use_refresh_token: true }),
       });
 
       const data = await resp.json();
@@ -45,8 +40,8 @@ export function useAuth() {
         return data.detail || '登录失败';
       }
 
-      const user: AuthUser = { email: data.email, token: data.token };
-      localStorage.setItem(AUTH_KEY, JSON.stringify(user));
+      const user: AuthUser = { email: data.email, token: data.token, refreshToken: data.refresh_token };
+      saveStoredAuth(user);
       setState({ user, isAuthenticated: true });
       return null; // success
     } catch {
@@ -59,7 +54,7 @@ export function useAuth() {
       const resp = await fetch(`${API_BASE_URL}/register`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ email, password }),
+        body: JSON.stringify({ email, password, use_refresh_token: true }),
       });
 
       const data = await resp.json();
@@ -68,8 +63,8 @@ export function useAuth() {
         return data.detail || '注册失败';
       }
 
-      const user: AuthUser = { email: data.email, token: data.token };
-      localStorage.setItem(AUTH_KEY, JSON.stringify(user));
+      const user: AuthUser = { email: data.email, token: data.token, refreshToken: data.refresh_token };
+      saveStoredAuth(user);
       setState({ user, isAuthenticated: true });
       return null; // success
     } catch {
@@ -78,6 +73,7 @@ export function useAuth() {
   }, []);
 
   const logout = useCallback(() => {
+    void revokeRefreshToken();
     localStorage.removeItem(AUTH_KEY);
     setState({ user: null, isAuthenticated: false });
   }, []);
@@ -0,0 +1,96 @@
+/**
+ * 登录令牌管理
+ * access token 短期有效；收到 401 时用 refresh token 换新并重试一次
+ */
+
+// 后端 API 地址 — 统一使用绝对地址，兼容网页/iOS/安卓
+const API_BASE_URL = 'http://106.14.148.230:8000/api';
+
+export const AUTH_KEY = 'cloud-auth';
+
+export interface StoredAuth {
+  email: string;
+  token: string;
+  refreshToken?: string;
+}
+
+export function loadStoredAuth(): StoredAuth | null {
+  try {
+    const raw = localStorage.getItem(AUTH_KEY);
+    if (raw) return JSON.parse(raw) as StoredAuth;
+  } catch { /* ignore */ }
+  return null;
+}
+
+export function saveStoredAuth(auth: StoredAuth): void {
+  localStorage.setItem(AUTH_KEY, JSON.stringify(auth));
+}
+
+export function getToken(): string {
+  return loadStoredAuth()?.token || '';
+}
+
+// 多个请求同时 401 时只发一次刷新
+let refreshing: Promise<boolean> | null = null;
+
+async function doRefresh(): Promise<boolean> {
+  const auth = loadStoredAuth();
+  if (!auth?.refreshToken) return false;
+  try {
+    const resp = await fetch(`${API_BASE_URL}/token/refresh`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ refresh_token: auth.refreshToken }),
+    });
+    // 另一个标签页可能刚用同一个 refresh token 换过新令牌并已写入本地
+    if (!resp.ok) return loadStoredAuth()?.refreshToken !== auth.refreshToken;
+    const data = await resp.json();
+    saveStoredAuth({ email: data.email, token: data.token, refreshToken: data.refresh_token });
+    return true;
+  } catch {
+    return false;
+  }
+}
+
+export function refreshAccessToken(): Promise<boolean> {
+  if (!refreshing) {
+    refreshing = doRefresh().finally(() => { refreshing = null; });
+  }
+  return refreshing;
+}
+
+/**
+ * 带登录令牌的 fetch；access token 过期时自动刷新后重试一次
+ */
+export async function authFetch(url: string, options: RequestInit = {}): Promise<Response> {
+  const send = (token: string) => fetch(url, {
+    ...options,
+    headers: {
+      'Content-Type': 'application/json',
+      'Authorization': `Bearer ${token}`,
+      ...(options.headers || {}),
+    },
+  });
+
+  const token = getToken();
+  if (!token) throw new Error('NOT_LOGGED_IN');
+
+  const resp = await send(token);
+  if (resp.status !== 401 || !(await refreshAccessToken())) return resp;
+  return send(getToken());
+}
+
+/**
+ * 退出登录时吊销 refresh token（失败不影响本地登出）
+ */
+export async function revokeRefreshToken(): Promise<void> {
+  const refreshToken = loadStoredAuth()?.refreshToken;
+  if (!refreshToken) return;
+  try {
+    await fetch(`${API_BASE_URL}/token/revoke`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ refresh_token: refreshToken }),
+    });
+  } catch { /* ignore */ }
+}
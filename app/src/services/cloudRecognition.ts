@@ -1,21 +1,10 @@
 import { cloudCards, cloudCardMap } from '@/data/cloudCards';
 import type { RecognitionResult, AIAnalysis } from '@/types/cloud';
+import { authFetch } from './authToken';
 
 // 后端 API 地址 — 统一使用绝对地址，兼容网页/iOS/安卓
 const API_BASE_URL = 'http://106.14.148.230:8000/api';
 
-// 获取登录 token
-function getToken(): string {
-  try {
-    const raw = localStorage.getItem('cloud-auth');
-    if (raw) {
-      const auth = JSON.parse(raw);
-      return auth.token || '';
-    }
-  } catch { /* ignore */ }
-  return '';
-}
-
 // 将 File 转为 base64
 function fileToBase64(file: File): Promise<string> {
   return new Promise((resolve, reject) => {
@@ -28,17 +17,8 @@ function fileToBase64(file: File): Promise<string> {
 
 // 调用后端识别 API
 async function callRecognizeAPI(imageBase64: string): Promise<ParsedResult> {
-  const token = getToken();
-  if (!token) {
-    throw new Error('NOT_LOGGED_IN');
-  }
-
-  const response = await fetch(`${API_BASE_URL}/recognize`, {
+  const response = await authFetch(`${API_BASE_URL}/recognize`, {
     method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-      'Authorization': `Bearer ${token}`,
-    },
     body: JSON.stringify({
       image_base64: imageBase64,
     }),
@@ -4,35 +4,11 @@
  */
 
 import type { UserState, AIAnalysis } from '@/types/cloud';
+import { authFetch } from './authToken';
 
 // 后端 API 地址 — 统一使用绝对地址，兼容网页/iOS/安卓
 const API_BASE_URL = 'http://106.14.148.230:8000/api';
 
-function getToken(): string {
-  try {
-    const raw = localStorage.getItem('cloud-auth');
-    if (raw) {
-      const auth = JSON.parse(raw);
-      return auth.token || '';
-    }
-  } catch { /* ignore */ }
-  return '';
-}
-
-async function authFetch(url: string, options: RequestInit = {}): Promise<Response> {
-  const token = getToken();
-  if (!token) throw new Error('NOT_LOGGED_IN');
-
-  return fetch(url, {
-    ...options,
-    headers: {
-      'Content-Type': 'application/json',
-      'Authorization': `Bearer ${token}`,
-      ...(options.headers || {}),
-    },
-  });
-}
-
 // ============ 响应类型 ============
 
 export interface ServerUserState {
@@ -35,8 +35,7 @@ echo ""
 
 # 第三步：上传后端文件
 echo "[3/4] 上传后端文件到服务器..."
-scp -P $SSH_PORT "$LOCAL_DIR/server/main.py" "$SERVER:$BACKEND_DEPLOY/main.py"
-scp -P $SSH_PORT "$LOCAL_DIR/server/card_data.py" "$SERVER:$BACKEND_DEPLOY/card_data.py"
+scp -P $SSH_PORT "$LOCAL_DIR/server/"*.py "$SERVER:$BACKEND_DEPLOY/"
 scp -P $SSH_PORT "$LOCAL_DIR/server/requirements.txt" "$SERVER:$BACKEND_DEPLOY/requirements.txt"
 echo "  ✅ 后端文件上传完成"
 echo ""
@@ -49,6 +48,7 @@ ssh -p $SSH_PORT $SERVER "
         source venv/bin/activate
         pip install -r requirements.txt -q
     fi
+    python3 static_files.py ${FRONTEND_DEPLOY}
     if command -v supervisorctl &> /dev/null; then
         supervisorctl restart cloud-api 2>/dev/null && echo '  ✅ Supervisor 重启成功' || echo '  ⚠️  Supervisor 重启失败'
     else
@@ -51,7 +51,7 @@ echo ""
 
 # 第四步：更新后端代码
 echo "[4/5] 更新后端代码..."
-cp "$REPO_DIR/server/main.py" "$BACKEND_DEPLOY/main.py"
+cp "$REPO_DIR/server/"*.py "$BACKEND_DEPLOY/"
 cp "$REPO_DIR/server/requirements.txt" "$BACKEND_DEPLOY/requirements.txt"
 
 # 安装后端依赖（使用虚拟环境）
@@ -61,6 +61,14 @@ if [ -d "$BACKEND_DEPLOY/venv" ]; then
     deactivate
 fi
 echo "  ✅ 后端代码已更新"
+
+# 预压缩前端文件（br/gzip），后端启动时直接读取，不必在每个 worker 里临时压缩
+PYTHON_BIN="python3"
+if [ -x "$BACKEND_DEPLOY/venv/bin/python" ]; then
+    PYTHON_BIN="$BACKEND_DEPLOY/venv/bin/python"
+fi
+"$PYTHON_BIN" "$BACKEND_DEPLOY/static_files.py" "$FRONTEND_DEPLOY"
+echo "  ✅ 前端预压缩完成"
 echo "  ⚠️  注意：.env 文件不会被覆盖，你的配置是安全的"
 echo ""
 
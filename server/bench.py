@@ -0,0 +1,470 @@
+"""
+后端性能基准脚本
+用法：
+  python bench.py state [--cards 85] [--records 20000]
+  python bench.py workers [--workers 1 2 4] [--concurrency 32] [--duration 5]
+  python bench.py db [--concurrency 200] [--duration 5]
+  python bench.py lit-race [--users 20] [--taps 4] [--db-mode threadpool]
+  python bench.py startup [--repeat 5]
+所有基准都使用临时数据库，不会触碰 DB_PATH 指向的正式库
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+
+def _use_temp_db() -> str:
+    """在导入 main 之前把 DB_PATH 指向临时文件"""
+    path = os.path.join(tempfile.mkdtemp(prefix="cloud-bench-"), "bench.db")
+    os.environ["DB_PATH"] = path
+    os.environ.setdefault("JWT_SECRET", "bench-secret-" + "0" * 32)
+    return path
+
+
+def _load_main():
+    """指向临时库后导入 main 并执行迁移"""
+    _use_temp_db()
+    import main
+
+    main.init_db()
+    return main
+
+
+def _timeit(fn, repeat: int) -> float:
+    """返回单次调用的最好耗时（毫秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def seed_user(main, n_cards: int, n_records: int) -> int:
+    """造一个收集了大量卡牌、点亮记录很多的合成用户"""
+    with main.get_db() as conn:
+        cursor = conn.execute(
+            "INSERT INTO users (email, password_hash, salt, created_at) VALUES (?, ?, ?, ?)",
+            (f"bench{random.randrange(10**9)}@example.com", "x", "x", datetime.utcnow().isoformat()),
+        )
+        user_id = cursor.lastrowid
+        main.init_user_state(conn, user_id)
+
+        card_ids = list(main.CARD_DATA)[:n_cards]
+        base = datetime.utcnow() - timedelta(days=365)
+        for i, card_id in enumerate(card_ids):
+            unlocked_at = (base + timedelta(hours=i)).isoformat()
+            conn.execute(
+                "INSERT OR REPLACE INTO user_cards (user_id, card_id, status, lit_count, unlocked_at, unlocked_at_ms) VALUES (?, ?, 'lit', 0, ?, ?)",
+                (user_id, card_id, unlocked_at, main.iso_to_ms(unlocked_at)),
+            )
+
+        text = "卷云呈白色细丝状，常见于晴朗天气的高空。" * 8
+        start_ms = int(base.timestamp() * 1000)
+        conn.executemany(
+            """INSERT INTO lit_records
+               (user_id, card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (user_id, random.choice(card_ids), start_ms + i * 60000, random.randint(0, 60),
+                 "高云族", "卷云", "毛卷云", text, text, text, base.isoformat())
+                for i in range(n_records)
+            ],
+        )
+        conn.execute(
+            "UPDATE user_cards SET lit_count = (SELECT COUNT(*) FROM lit_records r WHERE r.user_id = user_cards.user_id AND r.card_id = user_cards.card_id) WHERE user_id = ?",
+            (user_id,),
+        )
+        conn.commit()
+    return user_id
+
+
+def legacy_user_state(main, user_id: int) -> bytes:
+    """优化前的 get_user_state：sqlite3.Row 按名取值 + 逐卡解析日期 + jsonable_encoder"""
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    with main.get_db() as conn:
+        state_row = conn.execute(
+            "SELECT points, total_lit_count, streak_rarity, streak_count FROM user_state WHERE user_id = ?",
+            (user_id,),
+        ).fetchone()
+        card_rows = conn.execute(
+            "SELECT card_id, status, lit_count, unlocked_at FROM user_cards WHERE user_id = ?",
+            (user_id,),
+        ).fetchall()
+        record_rows = conn.execute(
+            "SELECT card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge FROM lit_records WHERE user_id = ? ORDER BY timestamp ASC",
+            (user_id,),
+        ).fetchall()
+
+    records_by_card = {}
+    for r in record_rows:
+        cid = r["card_id"]
+        if cid not in records_by_card:
+            records_by_card[cid] = []
+        records_by_card[cid].append({
+            "timestamp": r["timestamp"],
+            "earnedScore": r["earned_score"],
+            "aiAnalysis": {
+                "family": r["ai_family"] or "",
+                "genus": r["ai_genus"] or "",
+                "species": r["ai_species"] or "",
+                "features": r["ai_features"] or "",
+                "weather": r["ai_weather"] or "",
+                "knowledge": r["ai_knowledge"] or "",
+            },
+        })
+
+    cards = {}
+    for c in card_rows:
+        cid = c["card_id"]
+        unlocked_at = None
+        if c["unlocked_at"]:
+            try:
+                unlocked_at = int(datetime.fromisoformat(c["unlocked_at"]).timestamp() * 1000)
+            except Exception:
+                unlocked_at = None
+        cards[cid] = {
+            "cardId": cid,
+            "status": c["status"],
+            "litCount": c["lit_count"],
+            "litRecords": records_by_card.get(cid, []),
+            "unlockedAt": unlocked_at,
+        }
+
+    content = {
+        "points": state_row["points"],
+        "totalLitCount": state_row["total_lit_count"],
+        "streakRarity": state_row["streak_rarity"],
+        "streakCount": state_row["streak_count"],
+        "cards": cards,
+    }
+    return JSONResponse(jsonable_encoder(content)).body
+
+
+def bench_state(args):
+    main = _load_main()
+    from compression import compress_bytes
+
+    user_id = seed_user(main, args.cards, args.records)
+
+    def new_user_state() -> bytes:
+        with main.get_db() as conn:
+            return main.load_user_state(conn, user_id)
+
+    legacy_body = legacy_user_state(main, user_id)
+    new_body = new_user_state()
+    assert json.loads(legacy_body) == json.loads(new_body), "新旧路径输出不一致"
+
+    legacy_ms = _timeit(lambda: legacy_user_state(main, user_id), args.repeat)
+    new_ms = _timeit(new_user_state, args.repeat)
+    gzip_ms = _timeit(lambda: compress_bytes(new_body, "gzip"), args.repeat)
+
+    print(f"合成用户：{args.cards} 张卡，{args.records} 条点亮记录，响应 {len(new_body) / 1024:.0f} KiB")
+    print(f"  旧路径 (Row + 日期解析 + jsonable_encoder)：{legacy_ms:8.1f} ms")
+    print(f"  新路径 (按位置取列 + orjson)：            {new_ms:8.1f} ms  ({legacy_ms / new_ms:.1f}x)")
+    for encoding in ("gzip", "br"):
+        try:
+            size = len(compress_bytes(new_body, encoding))
+        except AttributeError:
+            continue  # 未安装 brotli
+        print(f"  {encoding:4s} 压缩后：{size / 1024:8.0f} KiB ({size / len(new_body):.0%})")
+    print(f"  gzip 压缩耗时：{gzip_ms:8.1f} ms")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url: str, timeout: float = 30.0, interval: float = 0.2):
+    import httpx
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(interval)
+    raise RuntimeError(f"服务未能在 {timeout}s 内启动：{url}")
+
+
+async def _hammer(url: str, headers: dict, concurrency: int, duration: float) -> list:
+    """在 duration 秒内用 concurrency 个并发连接持续请求，返回成功请求的耗时列表（秒）"""
+    import httpx
+
+    latencies = []
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(headers=headers, limits=limits, timeout=60.0) as client:
+        async def worker():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    resp = await client.get(url)
+                except httpx.TransportError:
+                    continue  # 连接被重置等，计为失败请求
+                if resp.status_code == 200:
+                    latencies.append(time.perf_counter() - start)
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+def _serve_and_hammer(workers: int, env: dict, path: str, headers: dict,
+                      concurrency: int, duration: float) -> list:
+    """用 serve.py 起一个临时服务，压测 path 后关闭"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(here, "serve.py"), "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers)],
+        env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        _wait_ready(base_url + "/api/health")
+        return asyncio.run(_hammer(base_url + path, headers, concurrency, duration))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+
+def _percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))] if ordered else float("nan")
+
+
+def bench_workers(args):
+    """用 serve.py 分别以不同 worker 数启动，压测 /api/user/state 的吞吐"""
+    main = _load_main()
+
+    user_id = seed_user(main, args.cards, args.records)
+    headers = {"Authorization": f"Bearer {main.create_token(user_id, 'bench@example.com')}"}
+
+    print(f"合成用户：{args.cards} 张卡，{args.records} 条点亮记录；并发 {args.concurrency}，每轮 {args.duration}s")
+    baseline = None
+    for workers in args.workers:
+        latencies = _serve_and_hammer(workers, {}, "/api/user/state", headers, args.concurrency, args.duration)
+        rps = len(latencies) / args.duration
+        baseline = baseline or rps
+        print(f"  {workers} worker(s)：{rps:8.1f} req/s  ({rps / baseline:.2f}x)")
+
+
+def bench_db(args):
+    """高并发下对比 DB_MODE=threadpool 与 DB_MODE=thread"""
+    main = _load_main()
+
+    user_id = seed_user(main, args.cards, args.records)
+    headers = {"Authorization": f"Bearer {main.create_token(user_id, 'bench@example.com')}"}
+
+    print(f"合成用户：{args.cards} 张卡，{args.records} 条点亮记录；并发 {args.concurrency}，每轮 {args.duration}s")
+    for mode in ("threadpool", "thread"):
+        latencies = _serve_and_hammer(1, {"DB_MODE": mode}, "/api/user/state", headers,
+                                      args.concurrency, args.duration)
+        rps = len(latencies) / args.duration
+        print(f"  DB_MODE={mode:10s} {rps:8.1f} req/s  "
+              f"p50 {_percentile(latencies, 0.5) * 1000:7.1f} ms  p99 {_percentile(latencies, 0.99) * 1000:7.1f} ms")
+
+
+def bench_lit_race(args):
+    """同一用户连点：每个用户并发发出多个点亮请求，之后用全量重算校验统计表"""
+    import httpx
+    import sqlite3
+    from stats import check_stats
+
+    main = _load_main()
+    headers = []
+    for _ in range(args.users):
+        user_id = seed_user(main, 0, 0)
+        headers.append({"Authorization": f"Bearer {main.create_token(user_id, 'bench@example.com')}"})
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = _free_port()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(here, "serve.py"), "--host", "127.0.0.1", "--port", str(port)],
+        env={**os.environ, "DB_MODE": args.db_mode}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        _wait_ready(base_url + "/api/health")
+
+        async def tap_all():
+            async with httpx.AsyncClient(timeout=60.0) as client:
+                return await asyncio.gather(*(
+                    client.post(base_url + "/api/user/lit", json={"card_id": args.card}, headers=h)
+                    for h in headers for _ in range(args.taps)
+                ))
+        responses = asyncio.run(tap_all())
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    conn = sqlite3.connect(os.environ["DB_PATH"])
+    lit_holders = conn.execute(
+        "SELECT COUNT(*) FROM user_cards WHERE card_id = ? AND status = 'lit'", (args.card,)
+    ).fetchone()[0]
+    stats_row = conn.execute(
+        "SELECT holders, lit_count FROM card_stats WHERE card_id = ?", (args.card,)
+    ).fetchone()
+    mismatches = check_stats(conn)
+    conn.close()
+
+    ok = sum(resp.status_code == 200 for resp in responses)
+    print(f"DB_MODE={args.db_mode}：{args.users} 个用户 × {args.taps} 次并发点亮 {args.card}，成功 {ok}/{len(responses)}")
+    print(f"  user_cards 点亮人数 {lit_holders}；card_stats holders={stats_row[0]} lit_count={stats_row[1]}")
+    print(f"  与全量重算不一致的行数：{mismatches}")
+    if any(mismatches.values()):
+        sys.exit(1)
+
+
+def _run_snippet(code: str, env: dict = None) -> list:
+    """在新的解释器里执行 code，返回最后一行输出的数字列表"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=here, env={**os.environ, **(env or {})},
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return [float(x) for x in out.strip().splitlines()[-1].split()]
+
+
+def _sample_image_base64() -> str:
+    import io
+    import base64
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (640, 480), (135, 206, 235)).save(buf, format="JPEG")
+    return "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode()
+
+
+def bench_startup(args):
+    """冷启动：导入 main、执行迁移、服务就绪与首个请求、首次识别的耗时"""
+    main = _load_main()
+    user_id = seed_user(main, args.cards, args.records)
+    headers = {"Authorization": f"Bearer {main.create_token(user_id, 'bench@example.com')}"}
+
+    # 旧：导入时加载 httpx / PIL / imagehash，并在导入时执行 init_db（每次都跑一遍建表语句）；
+    # 新：按需加载，迁移在 lifespan 里执行，已是最新版本时只读一次 user_version
+    import_code = "import time; t = time.perf_counter(); {}import main; {}print(time.perf_counter() - t)"
+    eager = min(_run_snippet(import_code.format(
+        "import httpx, imagehash, PIL.Image; ",
+        "import sqlite3; from migrations import _create_base_tables; "
+        "conn = sqlite3.connect(main.DB_PATH); _create_base_tables(conn); conn.commit(); conn.close(); ",
+    ))[0] for _ in range(args.repeat))
+    lazy = min(_run_snippet(import_code.format("", "main.init_db(); "))[0] for _ in range(args.repeat))
+    print(f"import main + 建表/迁移检查（取 {args.repeat} 次最好值）")
+    print(f"  旧：导入时加载 httpx / PIL / imagehash 并建表：{eager * 1000:8.1f} ms")
+    print(f"  新：按需加载，迁移只读 user_version：       {lazy * 1000:8.1f} ms  ({eager / lazy:.2f}x)")
+
+    from migrations import run_migrations
+
+    fresh_db = os.path.join(os.path.dirname(os.environ["DB_PATH"]), "fresh.db")
+    start = time.perf_counter()
+    run_migrations(fresh_db)
+    fresh_ms = (time.perf_counter() - start) * 1000
+    current_ms = _timeit(lambda: run_migrations(os.environ["DB_PATH"]), args.repeat)
+    print(f"迁移：新库全部执行 {fresh_ms:.1f} ms，已是最新版本时 {current_ms:.2f} ms")
+
+    # 旧路径每个请求都先 SELECT 一次 user_state；清空 _initialized_users 即可复现
+    def load_state(old: bool):
+        if old:
+            main._initialized_users.clear()
+        with main.get_db() as conn:
+            main.load_user_state(conn, user_id)
+
+    old_ms = _timeit(lambda: load_state(True), args.repeat * 20)
+    new_ms = _timeit(lambda: load_state(False), args.repeat * 20)
+    print(f"读取用户状态（load_user_state，取 {args.repeat * 20} 次最好值）")
+    print(f"  旧：每个请求先查 user_state：{old_ms:8.2f} ms")
+    print(f"  新：已初始化的用户跳过查询：{new_ms:8.2f} ms  ({old_ms / new_ms:.2f}x)")
+
+    import httpx
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(here, "serve.py"), "--host", "127.0.0.1", "--port", str(port)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_ready(base_url + "/api/health", interval=0.01)
+        ready = time.perf_counter() - start
+        latencies = []
+        for _ in range(2):
+            start = time.perf_counter()
+            httpx.get(base_url + "/api/user/state", headers=headers, timeout=30.0).raise_for_status()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    print(f"serve.py 启动到 /api/health 可用：{ready * 1000:.0f} ms")
+    print(f"  首个 /api/user/state：{latencies[0] * 1000:.1f} ms，第二个：{latencies[1] * 1000:.1f} ms")
+
+    first, second = _run_snippet(
+        "import os, time, main; image = os.environ['BENCH_IMAGE']; t0 = time.perf_counter(); "
+        "main.compute_phash(image); t1 = time.perf_counter(); main.compute_phash(image); "
+        "print(t1 - t0, time.perf_counter() - t1)",
+        {"BENCH_IMAGE": _sample_image_base64()},
+    )
+    print(f"识别前的感知哈希：首次（含导入图像栈）{first * 1000:.1f} ms，之后 {second * 1000:.1f} ms")
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Cloud Collection 后端基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("state", help="对比 /api/user/state 的新旧序列化路径")
+    p.add_argument("--cards", type=int, default=85)
+    p.add_argument("--records", type=int, default=20000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_state)
+
+    p = sub.add_parser("workers", help="对比不同 worker 数下的吞吐（验证多 worker 扩展）")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--cards", type=int, default=85)
+    p.add_argument("--records", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--duration", type=float, default=5.0)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("db", help="高并发下对比线程池与专用数据库线程两种 DB_MODE")
+    p.add_argument("--cards", type=int, default=20)
+    p.add_argument("--records", type=int, default=50)
+    p.add_argument("--concurrency", type=int, default=200)
+    p.add_argument("--duration", type=float, default=5.0)
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("lit-race", help="并发连点后校验统计表与全量重算一致")
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--taps", type=int, default=4)
+    p.add_argument("--card", default="cirrus")
+    p.add_argument("--db-mode", default="threadpool", choices=["threadpool", "thread"])
+    p.set_defaults(func=bench_lit_race)
+
+    p = sub.add_parser("startup", help="冷启动耗时：导入、迁移、首个请求、首次识别")
+    p.add_argument("--cards", type=int, default=20)
+    p.add_argument("--records", type=int, default=50)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_startup)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
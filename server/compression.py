@@ -0,0 +1,134 @@
+"""
+响应压缩中间件
+按 Accept-Encoding 协商 br / gzip，只压缩超过阈值的一次性响应体；
+流式响应和已经带 Content-Encoding 的响应原样透传；
+较大的响应体放到线程池里压缩，不阻塞事件循环（zlib / brotli 压缩时会释放 GIL）
+"""
+
+import gzip
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # 未安装 brotli 时只提供 gzip
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "application/x-ndjson",
+    "image/svg+xml",
+    "text/",
+)
+
+
+def parse_accept_encoding(value: str) -> dict:
+    """解析 Accept-Encoding，返回 {编码: q值}"""
+    result = {}
+    for part in value.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[token] = q
+    return result
+
+
+def negotiate_encoding(accept_encoding: str, available=None) -> str:
+    """按客户端偏好选出编码（br 优先于 gzip），无可用编码返回空字符串"""
+    if available is None:
+        available = ("br", "gzip") if brotli else ("gzip",)
+    accepted = parse_accept_encoding(accept_encoding)
+    best, best_q = "", 0.0
+    for encoding in available:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress_bytes(body: bytes, encoding: str, gzip_level: int = 6, brotli_quality: int = 4) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=brotli_quality)
+    return gzip.compress(body, compresslevel=gzip_level, mtime=0)
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    """ASGI 中间件：大响应按协商结果压缩"""
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4,
+                 threadpool_min_size: int = 64 * 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.threadpool_min_size = threadpool_min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                # 先扣住响应头，等看到第一段 body 再决定是否压缩
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                # pathsend 等非 body 消息：原样转发，但响应头必须先发出去
+                if start_message is not None:
+                    start, start_message = start_message, None
+                    await send(start)
+                await send(message)
+                return
+            if start_message is None:
+                await send(message)
+                return
+
+            start, start_message = start_message, None
+            headers = MutableHeaders(scope=start)
+            body = message.get("body", b"")
+            if (
+                message.get("more_body", False)
+                or "content-encoding" in headers
+                or len(body) < self.minimum_size
+                or not is_compressible(headers.get("content-type", ""))
+            ):
+                await send(start)
+                await send(message)
+                return
+
+            if len(body) >= self.threadpool_min_size:
+                compressed = await run_in_threadpool(
+                    compress_bytes, body, encoding, self.gzip_level, self.brotli_quality
+                )
+            else:
+                compressed = compress_bytes(body, encoding, self.gzip_level, self.brotli_quality)
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(compressed))
+            headers.add_vary_header("Accept-Encoding")
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_wrapper)
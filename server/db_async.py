@@ -0,0 +1,73 @@
+"""
+异步数据库访问层
+sqlite3 是阻塞 API。DatabaseThread 用一个专用线程持有长连接，
+协程把 fn(conn, *args) 投递到队列、await 结果，事件循环不会被阻塞，
+也不再占用 Starlette 默认线程池（40 个）的名额
+"""
+
+import queue
+import asyncio
+import sqlite3
+import threading
+
+_STOP = object()
+
+
+class DatabaseThread:
+    """专用数据库线程：按提交顺序逐个执行，出错时回滚当前事务"""
+
+    def __init__(self, path: str, name: str = "db-thread"):
+        self.path = path
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                fn, args, loop, future = item
+                try:
+                    result = fn(conn, *args)
+                except BaseException as exc:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    loop.call_soon_threadsafe(_set_exception, future, exc)
+                else:
+                    if conn.in_transaction:
+                        # 任务应自行提交；遗留的事务不能带到下一个任务
+                        conn.rollback()
+                    loop.call_soon_threadsafe(_set_result, future, result)
+        finally:
+            conn.close()
+
+    async def run(self, fn, *args):
+        """在数据库线程中执行 fn(conn, *args) 并返回其结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.put((fn, args, loop, future))
+        return await future
+
+    def close(self, timeout: float = 10.0):
+        """处理完已排队的任务后关闭连接"""
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+
+def _set_result(future, result):
+    # 请求可能已被取消（客户端断开），此时丢弃结果
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exc):
+    if not future.done():
+        future.set_exception(exc)
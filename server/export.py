@@ -0,0 +1,207 @@
+"""
+收集数据导出（NDJSON）
+每行一个 JSON 对象：先是 {"type": "user"}，然后是该用户的每张卡牌 {"type": "card"}，
+最后按时间顺序输出点亮记录 {"type": "record"}。数据从游标分批读取、边读边写，
+内存占用与历史记录条数无关。
+
+管理员导出全部用户：python export.py --all -o all.ndjson.gz
+"""
+
+import os
+import sys
+import zlib
+import asyncio
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterable, Iterator
+
+import orjson
+
+BATCH_SIZE = 500
+GZIP_CHUNK_BYTES = 64 * 1024
+
+
+def iter_user_lines(conn, user_id: int, batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    """逐行产出某个用户的 NDJSON（不含外层事务管理）"""
+    user = conn.execute(
+        """SELECT u.id, u.email, u.created_at, s.points, s.total_lit_count, s.streak_rarity, s.streak_count
+           FROM users u LEFT JOIN user_state s ON s.user_id = u.id WHERE u.id = ?""",
+        (user_id,),
+    ).fetchone()
+    if user is None:
+        return
+    uid, email, created_at, points, total_lit_count, streak_rarity, streak_count = user
+    yield orjson.dumps({
+        "type": "user",
+        "userId": uid,
+        "email": email,
+        "createdAt": created_at,
+        "points": points,
+        "totalLitCount": total_lit_count,
+        "streakRarity": streak_rarity,
+        "streakCount": streak_count,
+    }) + b"\n"
+
+    cursor = conn.execute(
+        "SELECT card_id, status, lit_count, unlocked_at_ms FROM user_cards WHERE user_id = ? ORDER BY card_id",
+        (user_id,),
+    )
+    for card_id, status, lit_count, unlocked_at_ms in _iter_rows(cursor, batch_size):
+        yield orjson.dumps({
+            "type": "card",
+            "cardId": card_id,
+            "status": status,
+            "litCount": lit_count,
+            "unlockedAt": unlocked_at_ms,
+        }) + b"\n"
+
+    cursor = conn.execute(
+        """SELECT card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge
+           FROM lit_records WHERE user_id = ? ORDER BY timestamp ASC""",
+        (user_id,),
+    )
+    for card_id, timestamp, earned_score, family, genus, species, features, weather, knowledge in _iter_rows(cursor, batch_size):
+        yield orjson.dumps({
+            "type": "record",
+            "cardId": card_id,
+            "timestamp": timestamp,
+            "earnedScore": earned_score,
+            "aiAnalysis": {
+                "family": family or "",
+                "genus": genus or "",
+                "species": species or "",
+                "features": features or "",
+                "weather": weather or "",
+                "knowledge": knowledge or "",
+            },
+        }) + b"\n"
+
+
+def _iter_rows(cursor, batch_size: int):
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def batch_lines(lines: Iterable[bytes], batch_size: int = BATCH_SIZE) -> Iterator[bytes]:
+    """把若干行合并成一个块再发送，减少 ASGI 消息数"""
+    buf = []
+    for line in lines:
+        buf.append(line)
+        if len(buf) >= batch_size:
+            yield b"".join(buf)
+            buf.clear()
+    if buf:
+        yield b"".join(buf)
+
+
+def gzip_chunks(chunks: Iterable[bytes], level: int = 6) -> Iterator[bytes]:
+    """流式 gzip 压缩"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 → gzip 格式
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            pending.append(out)
+            pending_size += len(out)
+        if pending_size >= GZIP_CHUNK_BYTES:
+            yield b"".join(pending)
+            pending, pending_size = [], 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+async def stream_user_export(db_path: str, user_id: int, compress: bool = False) -> AsyncIterator[bytes]:
+    """给 StreamingResponse 用的异步生成器：在一个读事务内导出，保证快照一致。
+    sqlite3 连接不能跨线程使用，所以连接的创建、每一批读取和关闭都在同一个专用线程里执行"""
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+
+    def open_export():
+        conn = sqlite3.connect(db_path)
+        conn.execute("BEGIN")
+        chunks = batch_lines(iter_user_lines(conn, user_id))
+        return conn, (gzip_chunks(chunks) if compress else chunks)
+
+    def close_export(conn, chunks):
+        chunks.close()
+        conn.close()
+
+    conn, chunks = await loop.run_in_executor(executor, open_export)
+    try:
+        while True:
+            chunk = await loop.run_in_executor(executor, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # 客户端断开时生成器可能在取消中关闭，这里不再 await，交给导出线程收尾
+        executor.submit(close_export, conn, chunks)
+        executor.shutdown(wait=False)
+
+
+def iter_all_users(conn, batch_users: int = 100) -> Iterator[bytes]:
+    """按 id 分批遍历全部用户；每批一个读事务，避免长时间持有快照"""
+    last_id = 0
+    while True:
+        conn.execute("BEGIN")
+        try:
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM users WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_users)
+            )]
+            for user_id in ids:
+                yield from iter_user_lines(conn, user_id)
+        finally:
+            conn.rollback()
+        if len(ids) < batch_users:
+            return
+        last_id = ids[-1]
+
+
+def main(argv=None):
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="导出用户收集数据为 NDJSON")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--all", action="store_true", help="导出全部用户")
+    target.add_argument("--user", type=int, help="只导出指定用户 id")
+    parser.add_argument("-o", "--output", default="-", help="输出文件，.gz 结尾时自动压缩；默认标准输出")
+    parser.add_argument("--batch-users", type=int, default=100, help="--all 时每批处理的用户数")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(os.getenv("DB_PATH", "cloud_collection.db"), isolation_level=None)
+    try:
+        if args.all:
+            lines = iter_all_users(conn, args.batch_users)
+        else:
+            lines = _in_read_tx(conn, iter_user_lines(conn, args.user))
+        chunks = batch_lines(lines)
+        if args.output.endswith(".gz"):
+            chunks = gzip_chunks(chunks)
+
+        out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+    finally:
+        conn.close()
+
+
+def _in_read_tx(conn, lines: Iterator[bytes]) -> Iterator[bytes]:
+    conn.execute("BEGIN")
+    try:
+        yield from lines
+    finally:
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
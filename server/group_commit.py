@@ -0,0 +1,112 @@
+"""
+组提交写入器
+把多个请求产生的非关键 INSERT（图片哈希、点亮记录、审计日志等）收集起来，
+每隔几毫秒或攒够 N 行在同一个事务里提交一次，用一次 fsync 摊薄所有写入。
+单队列 FIFO：语句严格按提交顺序执行
+"""
+
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger("cloud_collection.group_commit")
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """后台写线程，submit() 返回的 Future 在所在批次提交后完成"""
+
+    def __init__(self, path: str, interval_ms: float = 5, max_rows: int = 200):
+        self.path = path
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, sql: str, params: tuple = ()) -> Future:
+        if self._closed:
+            raise RuntimeError("GroupCommitWriter 已关闭")
+        future = Future()
+        self._queue.put((sql, params, future))
+        return future
+
+    def close(self, timeout: float = 10.0):
+        """停止接收新写入，把队列中剩余的写入全部提交后退出"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def _loop(self):
+        # 自行管理事务：isolation_level=None 时由我们显式 BEGIN / COMMIT
+        conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+        try:
+            stopping = False
+            while not stopping:
+                item = self._queue.get()
+                if item is _STOP:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.interval
+                while len(batch) < self.max_rows:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                self._flush(conn, batch)
+
+            # 关闭时把 _STOP 之后仍在队列里的写入也提交掉
+            rest = []
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP:
+                    rest.append(item)
+            if rest:
+                self._flush(conn, rest)
+        finally:
+            conn.close()
+
+    def _flush(self, conn: sqlite3.Connection, batch: list):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, params, future in batch:
+                try:
+                    conn.execute(sql, params)
+                    results.append((future, None))
+                except sqlite3.Error as exc:
+                    # 单条失败不影响同批其他写入（SQLite 语句级原子）
+                    results.append((future, exc))
+            conn.execute("COMMIT")
+        except sqlite3.Error as exc:
+            logger.exception("组提交失败，本批 %d 条写入丢弃", len(batch))
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for future, exc in results:
+            if exc is None:
+                future.set_result(None)
+            else:
+                logger.error("组提交中的写入失败：%s", exc)
+                future.set_exception(exc)
@@ -5,26 +5,38 @@ Cloud Collection 后端 API 服务
 
 import os
 import io
+import asyncio
+import logging
 import base64
 import sqlite3
 import hashlib
 import secrets
 import time
 from datetime import datetime, timedelta
-from contextlib import contextmanager
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List
 
-import httpx
 import jwt
-import imagehash
-from PIL import Image
-from fastapi import FastAPI, HTTPException, Depends, Header
+import orjson
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel, EmailStr
 from dotenv import load_dotenv
 
+from compression import CompressionMiddleware
+from static_files import StaticManifest
+from shared_state import AsyncState, create_shared_state
+from db_async import DatabaseThread
+from group_commit import GroupCommitWriter
+from migrations import run_migrations, iso_to_ms
+from stats import (
+    apply_card_change,
+    query_global_stats, query_leaderboard, query_user_points, query_rank_for_points,
+)
+from export import stream_user_export
 from card_data import (
     CARD_DATA, RARITY_UNLOCK_COSTS, INITIAL_POINTS,
     STARTER_CARD_IDS, COOLDOWN_MS, get_streak_multiplier,
@@ -32,83 +44,76 @@ from card_data import (
 
 load_dotenv()
 
+logger = logging.getLogger("cloud_collection")
+
 # ============ 配置 ============
 
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY", "")
-JWT_SECRET = os.getenv("JWT_SECRET", secrets.token_hex(32))
-JWT_EXPIRE_DAYS = 30
+# uvicorn --workers 的默认值同样取自 WEB_CONCURRENCY
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")
+SHARED_STATE_ADDR = os.getenv("SHARED_STATE_ADDR", "")
+
+# 仅限本地单进程开发：允许不设 JWT_SECRET，启动时生成随机密钥
+ALLOW_EPHEMERAL_JWT_SECRET = os.getenv("ALLOW_EPHEMERAL_JWT_SECRET", "") == "1"
+
+def load_jwt_secret() -> str:
+    """多 worker / 多节点必须共用同一个密钥，否则各进程签发的 token 互不认可。
+    uvicorn --workers N 不会设置 WEB_CONCURRENCY，无法从这里判断是否多进程，所以默认要求显式配置"""
+    secret = os.getenv("JWT_SECRET", "")
+    if secret:
+        return secret
+    if not ALLOW_EPHEMERAL_JWT_SECRET:
+        raise RuntimeError("必须设置 JWT_SECRET（本地单进程开发可设置 ALLOW_EPHEMERAL_JWT_SECRET=1 使用随机密钥）")
+    if WEB_CONCURRENCY > 1 or SHARED_STATE_BACKEND != "memory":
+        raise RuntimeError("多 worker 部署必须设置 JWT_SECRET")
+    logger.warning("未设置 JWT_SECRET，使用随机密钥：重启后所有登录失效，且不能多 worker 运行")
+    return secrets.token_hex(32)
+
+JWT_SECRET = load_jwt_secret()
+# access token 短期有效，过期后用 refresh token 换新，无需再做 PBKDF2
+ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "60"))
+# 登录/注册时没有声明 use_refresh_token 的旧客户端（已安装的旧版 App）没有刷新流程，仍签发长期 token
+LEGACY_ACCESS_TOKEN_EXPIRE_DAYS = int(os.getenv("LEGACY_ACCESS_TOKEN_EXPIRE_DAYS", "30"))
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "90"))
+# 刚被轮换掉的令牌在这段时间内再次出现，按并发刷新（多个标签页、客户端重试）处理，不视为泄露
+REFRESH_TOKEN_REUSE_GRACE_SECONDS = 30
+# 作废的令牌保留一段时间用于发现重放，之后与过期令牌一起清理
+REVOKED_REFRESH_TOKEN_RETENTION_DAYS = 7
+# 注册/登录的 PBKDF2 计算放在独立的有界线程池里，排队过长直接拒绝，避免登录潮挤占其他接口
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "30"))  # 秒
 DB_PATH = os.getenv("DB_PATH", "cloud_collection.db")
+# threadpool：每个请求在 Starlette 线程池里新开连接；thread：所有查询交给专用数据库线程
+DB_MODE = os.getenv("DB_MODE", "threadpool")
+# 非关键写入（图片哈希、点亮记录）的组提交：
+# off：每个请求自己提交；async：入队即返回，崩溃可能丢失最后几毫秒的写入；wait：等所在批次提交后再响应
+GROUP_COMMIT = os.getenv("GROUP_COMMIT", "off")
+GROUP_COMMIT_INTERVAL_MS = float(os.getenv("GROUP_COMMIT_INTERVAL_MS", "5"))
+GROUP_COMMIT_MAX_ROWS = int(os.getenv("GROUP_COMMIT_MAX_ROWS", "200"))
 DASHSCOPE_API_URL = "https://dashscope.aliyuncs.com/compatible-mode/v1/chat/completions"
 MODEL_NAME = "qwen-vl-plus"
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
 
 # ============ 数据库 ============
 
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            salt TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-    """)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS image_hashes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            phash TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-    """)
-    # 用户总体状态
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS user_state (
-            user_id INTEGER PRIMARY KEY REFERENCES users(id),
-            points INTEGER NOT NULL DEFAULT 30,
-            total_lit_count INTEGER NOT NULL DEFAULT 0,
-            streak_rarity TEXT,
-            streak_count INTEGER NOT NULL DEFAULT 0,
-            updated_at TEXT NOT NULL
-        )
-    """)
-    # 每张卡牌状态
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS user_cards (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL REFERENCES users(id),
-            card_id TEXT NOT NULL,
-            status TEXT NOT NULL DEFAULT 'locked',
-            lit_count INTEGER NOT NULL DEFAULT 0,
-            unlocked_at TEXT,
-            UNIQUE(user_id, card_id)
-        )
-    """)
-    # 点亮历史记录
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS lit_records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL REFERENCES users(id),
-            card_id TEXT NOT NULL,
-            timestamp INTEGER NOT NULL,
-            earned_score INTEGER NOT NULL DEFAULT 0,
-            ai_family TEXT,
-            ai_genus TEXT,
-            ai_species TEXT,
-            ai_features TEXT,
-            ai_weather TEXT,
-            ai_knowledge TEXT,
-            created_at TEXT NOT NULL
-        )
-    """)
-    # 索引
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_cards_user ON user_cards(user_id)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_lit_records_user_card ON lit_records(user_id, card_id)")
-    conn.commit()
-    conn.close()
+    """执行尚未执行的 schema 迁移（启动时调用；已是最新版本时只读一次 user_version）"""
+    applied = run_migrations(DB_PATH)
+    if applied:
+        logger.info("数据库迁移完成，执行了 %d 步", applied)
+
+# ============ 共享状态（缓存 / 限流 / single-flight） ============
 
-init_db()
+if WEB_CONCURRENCY > 1 and SHARED_STATE_BACKEND == "memory":
+    logger.warning("多 worker 运行但 SHARED_STATE_BACKEND=memory，缓存与限流只在各自进程内生效；建议用 serve.py 启动")
+
+# socket 后端的每次调用都是一次阻塞 IPC，交给 AsyncState 在专用线程中执行
+shared_state = AsyncState(
+    create_shared_state(SHARED_STATE_BACKEND, SHARED_STATE_ADDR, JWT_SECRET),
+    offload=SHARED_STATE_BACKEND != "memory",
+)
 
 @contextmanager
 def get_db():
@@ -119,27 +124,71 @@ def get_db():
     finally:
         conn.close()
 
+if DB_MODE not in ("threadpool", "thread"):
+    raise RuntimeError(f"未知的 DB_MODE: {DB_MODE}")
+
+db_thread = DatabaseThread(DB_PATH) if DB_MODE == "thread" else None
+
+if GROUP_COMMIT not in ("off", "async", "wait"):
+    raise RuntimeError(f"未知的 GROUP_COMMIT: {GROUP_COMMIT}")
+
+group_writer = None
+if GROUP_COMMIT != "off":
+    group_writer = GroupCommitWriter(DB_PATH, GROUP_COMMIT_INTERVAL_MS, GROUP_COMMIT_MAX_ROWS)
+
+def _run_with_new_conn(fn, *args):
+    with get_db() as conn:
+        return fn(conn, *args)
+
+def begin_write(conn):
+    """先拿写锁再读：sqlite3 默认到第一条写语句才开事务，
+    同一用户的并发请求会读到同一份旧状态，各自累加积分和统计表"""
+    conn.execute("BEGIN IMMEDIATE")
+
+async def run_db(fn, *args):
+    """在不阻塞事件循环的前提下执行 fn(conn, *args)，按 DB_MODE 选择执行方式"""
+    if db_thread is not None:
+        return await db_thread.run(fn, *args)
+    return await run_in_threadpool(_run_with_new_conn, fn, *args)
+
+async def submit_write(sql: str, params: tuple):
+    """把非关键 INSERT 交给组提交写入器；GROUP_COMMIT=wait 时等待落盘"""
+    future = group_writer.submit(sql, params)
+    if GROUP_COMMIT == "wait":
+        await asyncio.wrap_future(future)
+
 # ============ 用户状态初始化 ============
 
+# 本进程内已确认有收集状态的用户。注册时初始化、存量用户由迁移补齐，
+# 所以每个用户每个进程最多查一次库，之后的请求不再做存在性检查
+_initialized_users = set()
+
 def init_user_state(conn, user_id: int):
     """为新用户创建初始状态（30分 + 3张初始卡）"""
     now = datetime.utcnow().isoformat()
+    now_ms = iso_to_ms(now)
     conn.execute(
         "INSERT OR IGNORE INTO user_state (user_id, points, total_lit_count, streak_count, updated_at) VALUES (?, ?, 0, 0, ?)",
         (user_id, INITIAL_POINTS, now),
     )
     for card_id in STARTER_CARD_IDS:
-        conn.execute(
-            "INSERT OR IGNORE INTO user_cards (user_id, card_id, status, lit_count, unlocked_at) VALUES (?, ?, 'unlocked', 0, ?)",
-            (user_id, card_id, now),
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO user_cards (user_id, card_id, status, lit_count, unlocked_at, unlocked_at_ms) VALUES (?, ?, 'unlocked', 0, ?, ?)",
+            (user_id, card_id, now, now_ms),
         )
+        if cursor.rowcount:
+            apply_card_change(conn, user_id, card_id, None, "unlocked")
     conn.commit()
+    _initialized_users.add(user_id)
 
 def ensure_user_state(conn, user_id: int):
     """确保用户状态存在，不存在则初始化"""
+    if user_id in _initialized_users:
+        return
     row = conn.execute("SELECT user_id FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
     if not row:
         init_user_state(conn, user_id)
+    _initialized_users.add(user_id)
 
 # ============ 密码工具 ============
 
@@ -149,19 +198,78 @@ def hash_password(password: str, salt: str) -> str:
     ).hex()
 
 def verify_password(password: str, salt: str, password_hash: str) -> bool:
-    return hash_password(password, salt) == password_hash
+    return secrets.compare_digest(hash_password(password, salt), password_hash)
+
+password_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="pbkdf2")
+_password_pending = 0
+
+async def run_password_hash(fn, *args):
+    """在有界线程池中执行 PBKDF2，排队数超过上限时返回 503"""
+    global _password_pending
+    if _password_pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HTTPException(status_code=503, detail="登录请求过多，请稍后重试")
+    _password_pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(password_executor, fn, *args)
+    finally:
+        _password_pending -= 1
 
 # ============ JWT 工具 ============
 
-def create_token(user_id: int, email: str) -> str:
+def create_token(user_id: int, email: str, expires_in: Optional[timedelta] = None) -> str:
     payload = {
         "user_id": user_id,
         "email": email,
-        "exp": datetime.utcnow() + timedelta(days=JWT_EXPIRE_DAYS),
+        "exp": datetime.utcnow() + (expires_in or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)),
     }
     return jwt.encode(payload, JWT_SECRET, algorithm="HS256")
 
-def verify_token(authorization: str = Header(...)) -> dict:
+def hash_refresh_token(token: str) -> str:
+    # refresh token 本身是 256 位随机串，sha256 足够，不需要慢哈希
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def issue_refresh_token(conn, user_id: int) -> str:
+    """生成新的 refresh token 并入库（库中只保存哈希），调用方负责提交"""
+    # 每次签发顺带清理该用户的旧令牌，活跃用户的令牌行数不会无限增长
+    purge_refresh_tokens(conn, user_id)
+    token = secrets.token_urlsafe(32)
+    expires_at = int(time.time() * 1000) + REFRESH_TOKEN_EXPIRE_DAYS * 86400 * 1000
+    conn.execute(
+        "INSERT INTO refresh_tokens (user_id, token_hash, expires_at, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, hash_refresh_token(token), expires_at, datetime.utcnow().isoformat()),
+    )
+    return token
+
+def purge_refresh_tokens(conn, user_id: Optional[int] = None) -> int:
+    """删除已过期、以及作废超过保留期的 refresh token；不指定用户时清理全表（调用方负责提交）"""
+    now_ms = int(time.time() * 1000)
+    cutoff = (datetime.utcnow() - timedelta(days=REVOKED_REFRESH_TOKEN_RETENTION_DAYS)).isoformat()
+    sql = "DELETE FROM refresh_tokens WHERE (expires_at <= ? OR revoked_at < ?)"
+    params = (now_ms, cutoff)
+    if user_id is not None:
+        sql += " AND user_id = ?"
+        params += (user_id,)
+    return conn.execute(sql, params).rowcount
+
+def purge_refresh_tokens_tx(conn) -> int:
+    deleted = purge_refresh_tokens(conn)
+    conn.commit()
+    return deleted
+
+def auth_response(user_id: int, email: str, refresh_token: Optional[str]) -> "AuthResponse":
+    """有 refresh token 时签发短期 access token；旧客户端（refresh_token 为 None）签发长期 token"""
+    if refresh_token:
+        expires_in = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    else:
+        expires_in = timedelta(days=LEGACY_ACCESS_TOKEN_EXPIRE_DAYS)
+    return AuthResponse(
+        token=create_token(user_id, email, expires_in),
+        email=email,
+        refresh_token=refresh_token,
+        expires_in=int(expires_in.total_seconds()),
+    )
+
+async def verify_token(authorization: str = Header(...)) -> dict:
     if not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="无效的认证格式")
     token = authorization[7:]
@@ -178,14 +286,21 @@ def verify_token(authorization: str = Header(...)) -> dict:
 class RegisterRequest(BaseModel):
     email: EmailStr
     password: str
+    use_refresh_token: bool = False  # 支持刷新流程的客户端传 true
 
 class LoginRequest(BaseModel):
     email: EmailStr
     password: str
+    use_refresh_token: bool = False
 
 class AuthResponse(BaseModel):
     token: str
     email: str
+    refresh_token: Optional[str] = None
+    expires_in: int  # access token 有效期（秒）
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 class RecognizeRequest(BaseModel):
     image_base64: str  # 完整的 data:image/... base64 字符串
@@ -212,12 +327,17 @@ class MigrateStateRequest(BaseModel):
 # ============ 图片去重工具 ============
 
 PHASH_THRESHOLD = 5  # 汉明距离阈值，<=5 视为同一张图
+RECOGNIZE_FLIGHT_TTL = 90  # 秒，略大于 AI 调用超时，防止进程崩溃后锁不释放
 
 def compute_phash(image_base64: str) -> str:
     """从 base64 图片计算感知哈希"""
     # 去掉 data:image/xxx;base64, 前缀
     if "," in image_base64:
         image_base64 = image_base64.split(",", 1)[1]
+    # 图像栈（PIL / imagehash / numpy）只在第一次识别时导入，不拖慢 worker 启动
+    import imagehash
+    from PIL import Image
+
     raw = base64.b64decode(image_base64)
     img = Image.open(io.BytesIO(raw))
     return str(imagehash.phash(img))
@@ -227,6 +347,8 @@ def is_duplicate_image(conn, user_id: int, new_hash: str) -> bool:
     rows = conn.execute(
         "SELECT phash FROM image_hashes WHERE user_id = ?", (user_id,)
     ).fetchall()
+    import imagehash
+
     new_h = imagehash.hex_to_hash(new_hash)
     for row in rows:
         old_h = imagehash.hex_to_hash(row["phash"])
@@ -234,14 +356,19 @@ def is_duplicate_image(conn, user_id: int, new_hash: str) -> bool:
             return True
     return False
 
+INSERT_IMAGE_HASH_SQL = "INSERT INTO image_hashes (user_id, phash, created_at) VALUES (?, ?, ?)"
+
 def save_image_hash(conn, user_id: int, phash: str):
     """保存图片哈希到数据库"""
-    conn.execute(
-        "INSERT INTO image_hashes (user_id, phash, created_at) VALUES (?, ?, ?)",
-        (user_id, phash, datetime.utcnow().isoformat()),
-    )
+    conn.execute(INSERT_IMAGE_HASH_SQL, (user_id, phash, datetime.utcnow().isoformat()))
     conn.commit()
 
+async def store_image_hash(user_id: int, phash: str):
+    if group_writer is not None:
+        await submit_write(INSERT_IMAGE_HASH_SQL, (user_id, phash, datetime.utcnow().isoformat()))
+    else:
+        await run_db(save_image_hash, user_id, phash)
+
 # ============ 云朵识别提示词 ============
 
 CLOUD_RECOGNITION_PROMPT = """你是一位专业的云彩识别专家，精通《云彩收集者手册》中的所有云彩分类知识。
@@ -299,7 +426,25 @@ CLOUD_RECOGNITION_PROMPT = """你是一位专业的云彩识别专家，精通
 
 # ============ FastAPI 应用 ============
 
-app = FastAPI(title="Cloud Collection API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 建表/迁移放在启动阶段而不是导入时；多 worker 同时启动时只有一个真正执行
+    init_db()
+    # 不再登录的用户不会触发按用户清理，启动时对全表清理一次
+    deleted = await run_db(purge_refresh_tokens_tx)
+    if deleted:
+        logger.info("清理了 %d 个过期 / 作废的 refresh token", deleted)
+    yield
+    password_executor.shutdown(wait=False, cancel_futures=True)
+    shared_state.close()
+    if group_writer is not None:
+        group_writer.close()
+    if db_thread is not None:
+        db_thread.close()
+
+app = FastAPI(title="Cloud Collection API", version="1.0.0", lifespan=lifespan)
+
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESS_MIN_BYTES)
 
 app.add_middleware(
     CORSMiddleware,
@@ -312,339 +457,480 @@ app.add_middleware(
 # ---------- 健康检查 ----------
 
 @app.get("/api/health")
-def health_check():
+async def health_check():
     return {"status": "ok", "time": datetime.utcnow().isoformat()}
 
 # ---------- 用户注册 ----------
 
 @app.post("/api/register", response_model=AuthResponse)
-def register(req: RegisterRequest):
+async def register(req: RegisterRequest):
     if len(req.password) < 6:
         raise HTTPException(status_code=400, detail="密码至少需要6个字符")
 
     salt = secrets.token_hex(16)
-    password_hash = hash_password(req.password, salt)
-    created_at = datetime.utcnow().isoformat()
+    password_hash = await run_password_hash(hash_password, req.password, salt)
+    user_id, refresh_token = await run_db(register_tx, req.email, password_hash, salt, req.use_refresh_token)
 
-    with get_db() as conn:
-        try:
-            cursor = conn.execute(
-                "INSERT INTO users (email, password_hash, salt, created_at) VALUES (?, ?, ?, ?)",
-                (req.email, password_hash, salt, created_at),
-            )
-            conn.commit()
-            user_id = cursor.lastrowid
-        except sqlite3.IntegrityError:
-            raise HTTPException(status_code=400, detail="该邮箱已注册")
+    return auth_response(user_id, req.email, refresh_token)
 
-        # 注册后自动初始化收集状态
+def register_tx(conn, email: str, password_hash: str, salt: str, use_refresh_token: bool):
+    created_at = datetime.utcnow().isoformat()
+    try:
+        cursor = conn.execute(
+            "INSERT INTO users (email, password_hash, salt, created_at) VALUES (?, ?, ?, ?)",
+            (email, password_hash, salt, created_at),
+        )
+        user_id = cursor.lastrowid
+        refresh_token = issue_refresh_token(conn, user_id) if use_refresh_token else None
+        # 收集状态与账号在同一事务内创建，不会出现没有状态的用户
         init_user_state(conn, user_id)
-
-    token = create_token(user_id, req.email)
-    return AuthResponse(token=token, email=req.email)
+    except sqlite3.IntegrityError:
+        raise HTTPException(status_code=400, detail="该邮箱已注册")
+    return user_id, refresh_token
 
 # ---------- 用户登录 ----------
 
 @app.post("/api/login", response_model=AuthResponse)
-def login(req: LoginRequest):
-    with get_db() as conn:
-        row = conn.execute(
-            "SELECT id, email, password_hash, salt FROM users WHERE email = ?",
-            (req.email,),
-        ).fetchone()
+async def login(req: LoginRequest):
+    row = await run_db(fetch_login_row, req.email)
 
     if not row:
         raise HTTPException(status_code=400, detail="该邮箱尚未注册")
 
-    if not verify_password(req.password, row["salt"], row["password_hash"]):
+    if not await run_password_hash(verify_password, req.password, row["salt"], row["password_hash"]):
         raise HTTPException(status_code=400, detail="密码错误")
 
-    token = create_token(row["id"], row["email"])
-    return AuthResponse(token=token, email=row["email"])
+    refresh_token = await run_db(issue_refresh_token_tx, row["id"]) if req.use_refresh_token else None
+    return auth_response(row["id"], row["email"], refresh_token)
 
-# ---------- 获取用户收集状态 ----------
+def issue_refresh_token_tx(conn, user_id: int) -> str:
+    token = issue_refresh_token(conn, user_id)
+    conn.commit()
+    return token
+
+def fetch_login_row(conn, email: str):
+    return conn.execute(
+        "SELECT id, email, password_hash, salt FROM users WHERE email = ?",
+        (email,),
+    ).fetchone()
+
+# ---------- 刷新 / 吊销令牌 ----------
+
+@app.post("/api/token/refresh", response_model=AuthResponse)
+async def refresh_access_token(req: RefreshTokenRequest):
+    user_id, email, new_refresh_token = await run_db(rotate_refresh_token_tx, hash_refresh_token(req.refresh_token))
+    return auth_response(user_id, email, new_refresh_token)
+
+def rotate_refresh_token_tx(conn, token_hash: str):
+    """校验并轮换 refresh token：旧令牌作废、签发新令牌"""
+    row = conn.execute(
+        """SELECT t.id, t.user_id, t.expires_at, t.revoked_at, u.email
+           FROM refresh_tokens t JOIN users u ON u.id = t.user_id
+           WHERE t.token_hash = ?""",
+        (token_hash,),
+    ).fetchone()
+    if not row:
+        raise HTTPException(status_code=401, detail="登录已过期，请重新登录")
 
-@app.get("/api/user/state")
-def get_user_state(user: dict = Depends(verify_token)):
-    user_id = user["user_id"]
+    now = datetime.utcnow()
+    now_iso = now.isoformat()
+    if row["revoked_at"]:
+        reject_reused_refresh_token(conn, row["user_id"], row["revoked_at"], now)
+    if row["expires_at"] <= int(time.time() * 1000):
+        raise HTTPException(status_code=401, detail="登录已过期，请重新登录")
 
-    with get_db() as conn:
-        ensure_user_state(conn, user_id)
+    # 条件更新保证同一个令牌只能轮换一次：并发刷新时只有一个请求能改到这一行
+    cursor = conn.execute(
+        "UPDATE refresh_tokens SET revoked_at = ? WHERE id = ? AND revoked_at IS NULL",
+        (now_iso, row["id"]),
+    )
+    if cursor.rowcount != 1:
+        conn.rollback()
+        raise HTTPException(status_code=401, detail="登录已失效，请重新登录")
+    new_token = issue_refresh_token(conn, row["user_id"])
+    conn.commit()
+    return row["user_id"], row["email"], new_token
 
-        # 读取用户总体状态
-        state_row = conn.execute(
-            "SELECT points, total_lit_count, streak_rarity, streak_count FROM user_state WHERE user_id = ?",
-            (user_id,),
-        ).fetchone()
+def reject_reused_refresh_token(conn, user_id: int, revoked_at: str, now: datetime):
+    """已作废的令牌又被使用：刚轮换掉的视为并发刷新，只拒绝本次；否则可能已泄露，吊销该用户全部令牌"""
+    try:
+        recent = now - datetime.fromisoformat(revoked_at) < timedelta(seconds=REFRESH_TOKEN_REUSE_GRACE_SECONDS)
+    except ValueError:
+        recent = False
+    if not recent:
+        conn.execute(
+            "UPDATE refresh_tokens SET revoked_at = ? WHERE user_id = ? AND revoked_at IS NULL",
+            (now.isoformat(), user_id),
+        )
+        conn.commit()
+    raise HTTPException(status_code=401, detail="登录已失效，请重新登录")
 
-        # 读取所有卡牌状态
-        card_rows = conn.execute(
-            "SELECT card_id, status, lit_count, unlocked_at FROM user_cards WHERE user_id = ?",
-            (user_id,),
-        ).fetchall()
+@app.post("/api/token/revoke")
+async def revoke_token(req: RefreshTokenRequest):
+    await run_db(revoke_refresh_token_tx, hash_refresh_token(req.refresh_token))
+    return {"success": True}
 
-        # 读取所有点亮记录
-        record_rows = conn.execute(
-            "SELECT card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge FROM lit_records WHERE user_id = ? ORDER BY timestamp ASC",
-            (user_id,),
-        ).fetchall()
+def revoke_refresh_token_tx(conn, token_hash: str):
+    conn.execute(
+        "UPDATE refresh_tokens SET revoked_at = ? WHERE token_hash = ? AND revoked_at IS NULL",
+        (datetime.utcnow().isoformat(), token_hash),
+    )
+    conn.commit()
+
+# ---------- 获取用户收集状态 ----------
+
+@app.get("/api/user/state")
+async def get_user_state(user: dict = Depends(verify_token)):
+    # 查询和序列化都在 run_db 里完成，几 MB 的 JSON 不在事件循环上生成
+    body = await run_db(load_user_state, user["user_id"])
+    return Response(body, media_type="application/json")
+
+def load_user_state(conn, user_id: int) -> bytes:
+    """读取并序列化用户收集状态（orjson，跳过 jsonable_encoder）"""
+    ensure_user_state(conn, user_id)
+
+    # 读取用户总体状态
+    state_row = conn.execute(
+        "SELECT points, total_lit_count, streak_rarity, streak_count FROM user_state WHERE user_id = ?",
+        (user_id,),
+    ).fetchone()
+
+    # 读取所有卡牌状态
+    card_rows = conn.execute(
+        "SELECT card_id, status, lit_count, unlocked_at_ms, unlocked_at FROM user_cards WHERE user_id = ?",
+        (user_id,),
+    ).fetchall()
+
+    # 读取所有点亮记录
+    record_rows = conn.execute(
+        "SELECT card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge FROM lit_records WHERE user_id = ? ORDER BY timestamp ASC",
+        (user_id,),
+    ).fetchall()
 
+    return orjson.dumps(build_user_state(state_row, card_rows, record_rows))
+
+def build_user_state(state_row, card_rows, record_rows) -> dict:
+    """把数据库行组装成前端 UserState 结构（按位置取列，避免逐字段按名查找）"""
     # 组装卡牌记录
     records_by_card = {}
-    for r in record_rows:
-        cid = r["card_id"]
-        if cid not in records_by_card:
-            records_by_card[cid] = []
-        records_by_card[cid].append({
-            "timestamp": r["timestamp"],
-            "earnedScore": r["earned_score"],
+    for cid, timestamp, earned_score, family, genus, species, features, weather, knowledge in record_rows:
+        record = {
+            "timestamp": timestamp,
+            "earnedScore": earned_score,
             "aiAnalysis": {
-                "family": r["ai_family"] or "",
-                "genus": r["ai_genus"] or "",
-                "species": r["ai_species"] or "",
-                "features": r["ai_features"] or "",
-                "weather": r["ai_weather"] or "",
-                "knowledge": r["ai_knowledge"] or "",
+                "family": family or "",
+                "genus": genus or "",
+                "species": species or "",
+                "features": features or "",
+                "weather": weather or "",
+                "knowledge": knowledge or "",
             },
-        })
+        }
+        bucket = records_by_card.get(cid)
+        if bucket is None:
+            records_by_card[cid] = [record]
+        else:
+            bucket.append(record)
 
     # 组装卡牌状态
     cards = {}
-    for c in card_rows:
-        cid = c["card_id"]
-        unlocked_at = None
-        if c["unlocked_at"]:
-            try:
-                unlocked_at = int(datetime.fromisoformat(c["unlocked_at"]).timestamp() * 1000)
-            except Exception:
-                unlocked_at = None
+    for cid, status, lit_count, unlocked_at_ms, unlocked_at in card_rows:
+        if unlocked_at_ms is None and unlocked_at:
+            # 旧进程写入、尚未补齐毫秒列的行
+            unlocked_at_ms = iso_to_ms(unlocked_at)
         cards[cid] = {
             "cardId": cid,
-            "status": c["status"],
-            "litCount": c["lit_count"],
+            "status": status,
+            "litCount": lit_count,
             "litRecords": records_by_card.get(cid, []),
-            "unlockedAt": unlocked_at,
+            "unlockedAt": unlocked_at_ms,
         }
 
     return {
-        "points": state_row["points"],
-        "totalLitCount": state_row["total_lit_count"],
-        "streakRarity": state_row["streak_rarity"],
-        "streakCount": state_row["streak_count"],
+        "points": state_row[0],
+        "totalLitCount": state_row[1],
+        "streakRarity": state_row[2],
+        "streakCount": state_row[3],
         "cards": cards,
     }
 
+# ---------- 导出收集数据 ----------
+
+@app.get("/api/user/export")
+async def export_user_data(compress: Optional[str] = Query(None, pattern="^gzip$"),
+                           user: dict = Depends(verify_token)):
+    """NDJSON 流式导出（卡牌 + 全部点亮记录），compress=gzip 时返回 .ndjson.gz 文件"""
+    gzipped = compress == "gzip"
+    filename = f"cloud-collection-{user['user_id']}.ndjson" + (".gz" if gzipped else "")
+    return StreamingResponse(
+        stream_user_export(DB_PATH, user["user_id"], compress=gzipped),
+        media_type="application/gzip" if gzipped else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
 # ---------- 点亮卡牌 ----------
 
 @app.post("/api/user/lit")
-def lit_card(req: LitCardRequest, user: dict = Depends(verify_token)):
-    user_id = user["user_id"]
-    card_id = req.card_id
-
+async def lit_card(req: LitCardRequest, user: dict = Depends(verify_token)):
     # 验证卡牌存在
-    card_info = CARD_DATA.get(card_id)
-    if not card_info:
+    if req.card_id not in CARD_DATA:
         raise HTTPException(status_code=400, detail="无效的卡牌ID")
 
+    result, record = await run_db(lit_card_tx, user["user_id"], req, group_writer is not None)
+    if record is not None:
+        # 点亮记录交给组提交写入器，冷却判断不依赖它
+        await submit_write(INSERT_LIT_RECORD_SQL, record)
+    return result
+
+INSERT_LIT_RECORD_SQL = """INSERT INTO lit_records
+   (user_id, card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge, created_at)
+   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+
+def lit_card_tx(conn, user_id: int, req: LitCardRequest, defer_record: bool = False):
+    """返回 (响应, 待延迟写入的点亮记录)；defer_record 为 False 时记录在本事务内写入"""
+    card_id = req.card_id
+    card_info = CARD_DATA[card_id]
+
     now_ms = int(time.time() * 1000)
     now_iso = datetime.utcnow().isoformat()
 
-    with get_db() as conn:
-        ensure_user_state(conn, user_id)
+    ensure_user_state(conn, user_id)
+    begin_write(conn)
 
-        # 读取用户当前状态
-        state_row = conn.execute(
-            "SELECT points, total_lit_count, streak_rarity, streak_count FROM user_state WHERE user_id = ?",
-            (user_id,),
-        ).fetchone()
+    # 读取用户当前状态
+    state_row = conn.execute(
+        "SELECT points, total_lit_count, streak_rarity, streak_count FROM user_state WHERE user_id = ?",
+        (user_id,),
+    ).fetchone()
 
-        # 检查冷却
+    existing_card = conn.execute(
+        "SELECT id, status, lit_count, last_lit_ms FROM user_cards WHERE user_id = ? AND card_id = ?",
+        (user_id, card_id),
+    ).fetchone()
+
+    # 检查冷却
+    last_lit_ms = existing_card["last_lit_ms"] if existing_card else None
+    if last_lit_ms is None and existing_card and existing_card["lit_count"] > 0:
+        # 迁移导入的卡牌没有 last_lit_ms，回退查点亮记录
         last_record = conn.execute(
             "SELECT timestamp FROM lit_records WHERE user_id = ? AND card_id = ? ORDER BY timestamp DESC LIMIT 1",
             (user_id, card_id),
         ).fetchone()
-        in_cooldown = last_record and (now_ms - last_record["timestamp"]) < COOLDOWN_MS
-
-        # 计算连击和积分
-        base_score = card_info["score"]
-        card_rarity = card_info["rarity"]
-
-        if in_cooldown:
-            earned_score = 0
-            new_streak_count = state_row["streak_count"]
-            new_streak_rarity = state_row["streak_rarity"]
-        else:
-            is_same_rarity = state_row["streak_rarity"] == card_rarity
-            new_streak_count = (state_row["streak_count"] + 1) if is_same_rarity else 1
-            multiplier = get_streak_multiplier(new_streak_count)
-            earned_score = round(base_score * multiplier)
-            new_streak_rarity = card_rarity
-
-        # 插入点亮记录
+        last_lit_ms = last_record["timestamp"] if last_record else None
+    in_cooldown = last_lit_ms is not None and (now_ms - last_lit_ms) < COOLDOWN_MS
+
+    # 计算连击和积分
+    base_score = card_info["score"]
+    card_rarity = card_info["rarity"]
+
+    if in_cooldown:
+        earned_score = 0
+        new_streak_count = state_row["streak_count"]
+        new_streak_rarity = state_row["streak_rarity"]
+    else:
+        is_same_rarity = state_row["streak_rarity"] == card_rarity
+        new_streak_count = (state_row["streak_count"] + 1) if is_same_rarity else 1
+        multiplier = get_streak_multiplier(new_streak_count)
+        earned_score = round(base_score * multiplier)
+        new_streak_rarity = card_rarity
+
+    # 插入点亮记录
+    record = (user_id, card_id, now_ms, earned_score,
+              req.ai_family, req.ai_genus, req.ai_species,
+              req.ai_features, req.ai_weather, req.ai_knowledge, now_iso)
+    if not defer_record:
+        conn.execute(INSERT_LIT_RECORD_SQL, record)
+
+    # 更新卡牌状态
+    if existing_card:
         conn.execute(
-            """INSERT INTO lit_records
-               (user_id, card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (user_id, card_id, now_ms, earned_score,
-             req.ai_family, req.ai_genus, req.ai_species,
-             req.ai_features, req.ai_weather, req.ai_knowledge, now_iso),
+            "UPDATE user_cards SET status = 'lit', lit_count = ?, last_lit_ms = ? WHERE id = ?",
+            (existing_card["lit_count"] + 1, now_ms, existing_card["id"]),
         )
-
-        # 更新卡牌状态
-        existing_card = conn.execute(
-            "SELECT id, lit_count FROM user_cards WHERE user_id = ? AND card_id = ?",
-            (user_id, card_id),
-        ).fetchone()
-
-        if existing_card:
-            conn.execute(
-                "UPDATE user_cards SET status = 'lit', lit_count = ? WHERE id = ?",
-                (existing_card["lit_count"] + 1, existing_card["id"]),
-            )
-        else:
-            conn.execute(
-                "INSERT INTO user_cards (user_id, card_id, status, lit_count) VALUES (?, ?, 'lit', 1)",
-                (user_id, card_id),
-            )
-
-        # 更新用户总体状态
-        new_points = state_row["points"] + earned_score
-        new_total_lit = state_row["total_lit_count"] + (0 if in_cooldown else 1)
+    else:
         conn.execute(
-            "UPDATE user_state SET points = ?, total_lit_count = ?, streak_rarity = ?, streak_count = ?, updated_at = ? WHERE user_id = ?",
-            (new_points, new_total_lit, new_streak_rarity, new_streak_count, now_iso, user_id),
+            "INSERT INTO user_cards (user_id, card_id, status, lit_count, last_lit_ms) VALUES (?, ?, 'lit', 1, ?)",
+            (user_id, card_id, now_ms),
         )
+    apply_card_change(conn, user_id, card_id, existing_card["status"] if existing_card else None, "lit", 1)
 
-        conn.commit()
+    # 更新用户总体状态
+    new_points = state_row["points"] + earned_score
+    new_total_lit = state_row["total_lit_count"] + (0 if in_cooldown else 1)
+    conn.execute(
+        "UPDATE user_state SET points = ?, total_lit_count = ?, streak_rarity = ?, streak_count = ?, updated_at = ? WHERE user_id = ?",
+        (new_points, new_total_lit, new_streak_rarity, new_streak_count, now_iso, user_id),
+    )
 
-    return {
+    conn.commit()
+
+    result = {
         "earnedScore": earned_score,
         "newPoints": new_points,
         "streakCount": new_streak_count,
         "streakRarity": new_streak_rarity,
-        "inCooldown": bool(in_cooldown),
+        "inCooldown": in_cooldown,
     }
+    return result, (record if defer_record else None)
 
 # ---------- 解锁卡牌 ----------
 
 @app.post("/api/user/unlock")
-def unlock_card(req: UnlockCardRequest, user: dict = Depends(verify_token)):
-    user_id = user["user_id"]
-    card_id = req.card_id
-
-    card_info = CARD_DATA.get(card_id)
-    if not card_info:
+async def unlock_card(req: UnlockCardRequest, user: dict = Depends(verify_token)):
+    if req.card_id not in CARD_DATA:
         raise HTTPException(status_code=400, detail="无效的卡牌ID")
 
+    return await run_db(unlock_card_tx, user["user_id"], req.card_id)
+
+def unlock_card_tx(conn, user_id: int, card_id: str) -> dict:
+    card_info = CARD_DATA[card_id]
     cost = RARITY_UNLOCK_COSTS.get(card_info["rarity"], 999999)
     now_iso = datetime.utcnow().isoformat()
+    now_ms = iso_to_ms(now_iso)
 
-    with get_db() as conn:
-        ensure_user_state(conn, user_id)
+    ensure_user_state(conn, user_id)
+    begin_write(conn)
 
-        state_row = conn.execute(
-            "SELECT points FROM user_state WHERE user_id = ?",
-            (user_id,),
-        ).fetchone()
+    state_row = conn.execute(
+        "SELECT points FROM user_state WHERE user_id = ?",
+        (user_id,),
+    ).fetchone()
 
-        if state_row["points"] < cost:
-            raise HTTPException(status_code=400, detail="积分不足")
+    if state_row["points"] < cost:
+        raise HTTPException(status_code=400, detail="积分不足")
 
-        # 检查卡牌是否已经是 lit（不降级）
-        existing_card = conn.execute(
-            "SELECT status FROM user_cards WHERE user_id = ? AND card_id = ?",
-            (user_id, card_id),
-        ).fetchone()
+    # 检查卡牌是否已经是 lit（不降级）
+    existing_card = conn.execute(
+        "SELECT status FROM user_cards WHERE user_id = ? AND card_id = ?",
+        (user_id, card_id),
+    ).fetchone()
 
-        if existing_card and existing_card["status"] == "lit":
-            return {"success": True, "newPoints": state_row["points"]}
+    if existing_card and existing_card["status"] == "lit":
+        conn.rollback()
+        return {"success": True, "newPoints": state_row["points"]}
 
-        # 扣分并更新卡牌状态
-        new_points = state_row["points"] - cost
-
-        if existing_card:
-            conn.execute(
-                "UPDATE user_cards SET status = 'unlocked', unlocked_at = ? WHERE user_id = ? AND card_id = ?",
-                (now_iso, user_id, card_id),
-            )
-        else:
-            conn.execute(
-                "INSERT INTO user_cards (user_id, card_id, status, lit_count, unlocked_at) VALUES (?, ?, 'unlocked', 0, ?)",
-                (user_id, card_id, now_iso),
-            )
+    # 扣分并更新卡牌状态
+    new_points = state_row["points"] - cost
 
+    if existing_card:
+        conn.execute(
+            "UPDATE user_cards SET status = 'unlocked', unlocked_at = ?, unlocked_at_ms = ? WHERE user_id = ? AND card_id = ?",
+            (now_iso, now_ms, user_id, card_id),
+        )
+    else:
         conn.execute(
-            "UPDATE user_state SET points = ?, updated_at = ? WHERE user_id = ?",
-            (new_points, now_iso, user_id),
+            "INSERT INTO user_cards (user_id, card_id, status, lit_count, unlocked_at, unlocked_at_ms) VALUES (?, ?, 'unlocked', 0, ?, ?)",
+            (user_id, card_id, now_iso, now_ms),
         )
+    apply_card_change(conn, user_id, card_id, existing_card["status"] if existing_card else None, "unlocked")
 
-        conn.commit()
+    conn.execute(
+        "UPDATE user_state SET points = ?, updated_at = ? WHERE user_id = ?",
+        (new_points, now_iso, user_id),
+    )
+
+    conn.commit()
 
     return {"success": True, "newPoints": new_points}
 
 # ---------- 迁移本地数据 ----------
 
 @app.post("/api/user/migrate")
-def migrate_state(req: MigrateStateRequest, user: dict = Depends(verify_token)):
-    user_id = user["user_id"]
+async def migrate_state(req: MigrateStateRequest, user: dict = Depends(verify_token)):
+    return await run_db(migrate_state_tx, user["user_id"], req)
+
+def migrate_state_tx(conn, user_id: int, req: MigrateStateRequest) -> dict:
     now_iso = datetime.utcnow().isoformat()
 
-    with get_db() as conn:
-        ensure_user_state(conn, user_id)
+    ensure_user_state(conn, user_id)
+    begin_write(conn)
 
-        # 检查服务端是否已有有意义的数据
-        state_row = conn.execute(
-            "SELECT total_lit_count FROM user_state WHERE user_id = ?",
-            (user_id,),
-        ).fetchone()
+    # 检查服务端是否已有有意义的数据
+    state_row = conn.execute(
+        "SELECT total_lit_count FROM user_state WHERE user_id = ?",
+        (user_id,),
+    ).fetchone()
 
-        if state_row["total_lit_count"] > 0:
-            # 服务端已有数据，不覆盖，直接返回当前状态
-            return {"migrated": False, "message": "服务端已有数据，跳过迁移"}
+    if state_row["total_lit_count"] > 0:
+        # 服务端已有数据，不覆盖，直接返回当前状态
+        conn.rollback()
+        return {"migrated": False, "message": "服务端已有数据，跳过迁移"}
+
+    # 写入总体状态
+    conn.execute(
+        "UPDATE user_state SET points = ?, total_lit_count = ?, streak_rarity = ?, streak_count = ?, updated_at = ? WHERE user_id = ?",
+        (req.points, req.total_lit_count, req.streak_rarity, req.streak_count, now_iso, user_id),
+    )
 
-        # 写入总体状态
+    # 写入卡牌状态和点亮记录
+    old_cards = {
+        row["card_id"]: (row["status"], row["lit_count"])
+        for row in conn.execute("SELECT card_id, status, lit_count FROM user_cards WHERE user_id = ?", (user_id,))
+    }
+    for card_id, card_data in req.cards.items():
+        status = card_data.get("status", "locked")
+        lit_count = card_data.get("litCount", 0)
+        unlocked_at = None
+        if card_data.get("unlockedAt"):
+            try:
+                unlocked_at = datetime.fromtimestamp(card_data["unlockedAt"] / 1000).isoformat()
+            except Exception:
+                unlocked_at = now_iso
+
+        records = []
+        for record in card_data.get("litRecords", []):
+            ai = record.get("aiAnalysis", {}) or {}
+            records.append((
+                user_id, card_id,
+                record.get("timestamp", int(time.time() * 1000)),
+                record.get("earnedScore", 0),
+                ai.get("family", ""), ai.get("genus", ""),
+                ai.get("species", ""), ai.get("features", ""),
+                ai.get("weather", ""), ai.get("knowledge", ""),
+                now_iso,
+            ))
+        last_lit_ms = max((r[2] for r in records), default=None)
+
+        # 插入或更新卡牌
         conn.execute(
-            "UPDATE user_state SET points = ?, total_lit_count = ?, streak_rarity = ?, streak_count = ?, updated_at = ? WHERE user_id = ?",
-            (req.points, req.total_lit_count, req.streak_rarity, req.streak_count, now_iso, user_id),
+            "INSERT OR REPLACE INTO user_cards (user_id, card_id, status, lit_count, unlocked_at, unlocked_at_ms, last_lit_ms) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (user_id, card_id, status, lit_count, unlocked_at, iso_to_ms(unlocked_at), last_lit_ms),
         )
 
-        # 写入卡牌状态和点亮记录
-        for card_id, card_data in req.cards.items():
-            status = card_data.get("status", "locked")
-            lit_count = card_data.get("litCount", 0)
-            unlocked_at = None
-            if card_data.get("unlockedAt"):
-                try:
-                    unlocked_at = datetime.fromtimestamp(card_data["unlockedAt"] / 1000).isoformat()
-                except Exception:
-                    unlocked_at = now_iso
-
-            # 插入或更新卡牌
-            conn.execute(
-                "INSERT OR REPLACE INTO user_cards (user_id, card_id, status, lit_count, unlocked_at) VALUES (?, ?, ?, ?, ?)",
-                (user_id, card_id, status, lit_count, unlocked_at),
-            )
+        old_status, old_lit_count = old_cards.get(card_id, (None, 0))
+        apply_card_change(conn, user_id, card_id, old_status, status, lit_count - old_lit_count)
 
-            # 插入点亮记录
-            for record in card_data.get("litRecords", []):
-                ai = record.get("aiAnalysis", {}) or {}
-                conn.execute(
-                    """INSERT INTO lit_records
-                       (user_id, card_id, timestamp, earned_score, ai_family, ai_genus, ai_species, ai_features, ai_weather, ai_knowledge, created_at)
-                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (user_id, card_id,
-                     record.get("timestamp", int(time.time() * 1000)),
-                     record.get("earnedScore", 0),
-                     ai.get("family", ""), ai.get("genus", ""),
-                     ai.get("species", ""), ai.get("features", ""),
-                     ai.get("weather", ""), ai.get("knowledge", ""),
-                     now_iso),
-                )
+        # 插入点亮记录
+        conn.executemany(INSERT_LIT_RECORD_SQL, records)
 
-        conn.commit()
+    conn.commit()
 
     return {"migrated": True, "message": "迁移成功"}
 
+# ---------- 全局统计 / 排行榜 ----------
+
+async def cached_query(key: str, fn, *args):
+    """读共享缓存，未命中时查库并写回（各 worker 共用，TTL 内最多重算一次/worker）"""
+    value = await shared_state.get(key)
+    if value is None:
+        value = await run_db(fn, *args)
+        await shared_state.set(key, value, ttl=STATS_CACHE_TTL)
+    return value
+
+@app.get("/api/stats/global")
+async def global_stats(limit: int = Query(20, ge=1, le=100), user: dict = Depends(verify_token)):
+    return await cached_query(f"stats:global:{limit}", query_global_stats, limit)
+
+@app.get("/api/stats/leaderboard")
+async def leaderboard(limit: int = Query(20, ge=1, le=100), user: dict = Depends(verify_token)):
+    top = await cached_query(f"stats:leaderboard:{limit}", query_leaderboard, limit)
+    me = None
+    points = await run_db(query_user_points, user["user_id"])
+    if points is not None:
+        rank = await cached_query(f"stats:rank:{points}", query_rank_for_points, points)
+        me = {"rank": rank, "points": points}
+    return {"top": top, "me": me}
+
 # ---------- 云朵识别 ----------
 
 @app.post("/api/recognize")
@@ -655,14 +941,28 @@ async def recognize(req: RecognizeRequest, user: dict = Depends(verify_token)):
     # 计算图片 pHash 并检查是否重复
     user_id = user["user_id"]
     try:
-        img_phash = compute_phash(req.image_base64)
+        img_phash = await run_in_threadpool(compute_phash, req.image_base64)
     except Exception:
         img_phash = None  # 哈希计算失败不阻断识别
 
     if img_phash:
-        with get_db() as conn:
-            if is_duplicate_image(conn, user_id, img_phash):
-                raise HTTPException(status_code=409, detail="DUPLICATE_IMAGE")
+        if await run_db(is_duplicate_image, user_id, img_phash):
+            raise HTTPException(status_code=409, detail="DUPLICATE_IMAGE")
+
+        # 同一张图并发提交（连点、重试）只放行一个请求去调用 AI
+        flight_key = f"recognize:{user_id}:{img_phash}"
+        if not await shared_state.add(flight_key, 1, ttl=RECOGNIZE_FLIGHT_TTL):
+            raise HTTPException(status_code=409, detail="DUPLICATE_IMAGE")
+        try:
+            return await recognize_image(req.image_base64, user_id, img_phash)
+        finally:
+            await shared_state.delete(flight_key)
+
+    return await recognize_image(req.image_base64, user_id, img_phash)
+
+async def recognize_image(image_base64: str, user_id: int, img_phash: Optional[str]) -> dict:
+    """调用 DashScope 识别，成功后记录图片哈希"""
+    import httpx
 
     payload = {
         "model": MODEL_NAME,
@@ -670,7 +970,7 @@ async def recognize(req: RecognizeRequest, user: dict = Depends(verify_token)):
             {
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": req.image_base64}},
+                    {"type": "image_url", "image_url": {"url": image_base64}},
                     {"type": "text", "text": CLOUD_RECOGNITION_PROMPT},
                 ],
             }
@@ -710,28 +1010,30 @@ async def recognize(req: RecognizeRequest, user: dict = Depends(verify_token)):
 
     # 识别成功，保存图片哈希防止重复提交
     if img_phash:
-        with get_db() as conn:
-            save_image_hash(conn, user_id, img_phash)
+        await store_image_hash(user_id, img_phash)
 
     return {"content": content}
 
 # ============ 前端静态文件托管 ============
 
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
+STATIC_SENDFILE_MIN_BYTES = int(os.getenv("STATIC_SENDFILE_MIN_BYTES", str(1024 * 1024)))
 
 if os.path.isdir(STATIC_DIR):
-    # 托管静态资源（JS/CSS/图片等）
-    app.mount("/assets", StaticFiles(directory=os.path.join(STATIC_DIR, "assets")), name="static-assets")
+    # 启动时建立静态文件清单（含 br/gzip 预压缩版本），请求阶段不再查磁盘
+    static_manifest = StaticManifest(STATIC_DIR, sendfile_min_bytes=STATIC_SENDFILE_MIN_BYTES)
+    index_entry = static_manifest.get("index.html")
 
     # 所有非 /api 路径返回 index.html（SPA 路由）
     @app.get("/{full_path:path}")
-    async def serve_spa(full_path: str):
-        # 先检查是否是静态文件
-        file_path = os.path.join(STATIC_DIR, full_path)
-        if full_path and os.path.isfile(file_path):
-            return FileResponse(file_path)
-        # 否则返回 index.html
-        return FileResponse(os.path.join(STATIC_DIR, "index.html"))
+    async def serve_spa(full_path: str, request: Request):
+        # 先检查是否是静态文件，否则返回 index.html
+        entry = static_manifest.get(full_path) if full_path else None
+        if entry is None and not full_path.startswith("assets/"):
+            entry = index_entry
+        if entry is None:
+            raise HTTPException(status_code=404, detail="Not Found")
+        return static_manifest.response(entry, request.headers)
 
 # ============ 启动入口 ============
 
@@ -0,0 +1,224 @@
+"""
+数据库版本化迁移
+PRAGMA user_version 记录已执行到第几步，启动时只读一次版本号；
+有待执行的步骤时在一个写事务内依次执行并更新版本号，多个 worker 同时启动也只会有一个真正执行。
+新增表/列：在 MIGRATIONS 末尾追加一个函数，不要修改已发布的步骤。
+
+手动执行：python migrations.py
+"""
+
+import os
+import logging
+import sqlite3
+from datetime import datetime
+from typing import Optional
+
+from card_data import INITIAL_POINTS, STARTER_CARD_IDS
+from stats import init_stats_tables, rebuild_stats
+
+logger = logging.getLogger("cloud_collection.migrations")
+
+
+def add_column_if_missing(conn, table: str, column: str, decl: str) -> bool:
+    """旧库补列，返回是否新增了该列"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    return True
+
+
+def iso_to_ms(value: Optional[str]) -> Optional[int]:
+    """ISO 时间字符串转毫秒时间戳（与前端 unlockedAt 口径一致）"""
+    if not value:
+        return None
+    try:
+        return int(datetime.fromisoformat(value).timestamp() * 1000)
+    except Exception:
+        return None
+
+
+# ============ 迁移步骤（只追加，不修改） ============
+# 引入 user_version 之前的库版本号为 0，但可能已有部分表/列，所以每一步都要能在这种库上重复执行
+
+def _create_base_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            salt TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS image_hashes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            phash TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    # 用户总体状态
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY REFERENCES users(id),
+            points INTEGER NOT NULL DEFAULT 30,
+            total_lit_count INTEGER NOT NULL DEFAULT 0,
+            streak_rarity TEXT,
+            streak_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    # 每张卡牌状态
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_cards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            card_id TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'locked',
+            lit_count INTEGER NOT NULL DEFAULT 0,
+            unlocked_at TEXT,
+            UNIQUE(user_id, card_id)
+        )
+    """)
+    # 点亮历史记录
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS lit_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            card_id TEXT NOT NULL,
+            timestamp INTEGER NOT NULL,
+            earned_score INTEGER NOT NULL DEFAULT 0,
+            ai_family TEXT,
+            ai_genus TEXT,
+            ai_species TEXT,
+            ai_features TEXT,
+            ai_weather TEXT,
+            ai_knowledge TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_cards_user ON user_cards(user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lit_records_user_card ON lit_records(user_id, card_id)")
+
+
+def _add_unlocked_at_ms(conn):
+    # 解锁时间预先存成毫秒整数，读取状态时不再逐行解析日期
+    if add_column_if_missing(conn, "user_cards", "unlocked_at_ms", "INTEGER"):
+        rows = conn.execute(
+            "SELECT id, unlocked_at FROM user_cards WHERE unlocked_at IS NOT NULL"
+        ).fetchall()
+        conn.executemany(
+            "UPDATE user_cards SET unlocked_at_ms = ? WHERE id = ?",
+            [(iso_to_ms(unlocked_at), row_id) for row_id, unlocked_at in rows],
+        )
+
+
+def _add_last_lit_ms(conn):
+    # 冷却判断改读卡牌上的最后点亮时间，点亮记录本身可以延迟写入
+    if add_column_if_missing(conn, "user_cards", "last_lit_ms", "INTEGER"):
+        conn.execute("""
+            UPDATE user_cards SET last_lit_ms = (
+                SELECT MAX(timestamp) FROM lit_records r
+                WHERE r.user_id = user_cards.user_id AND r.card_id = user_cards.card_id
+            )
+        """)
+
+
+def _create_refresh_tokens(conn):
+    # 刷新令牌（只存哈希）
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            token_hash TEXT UNIQUE NOT NULL,
+            expires_at INTEGER NOT NULL,
+            revoked_at TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user ON refresh_tokens(user_id)")
+
+
+def _backfill_user_state(conn):
+    # 以前靠每个请求检查并补建收集状态；这里一次性补齐，之后只在注册时初始化
+    now = datetime.utcnow().isoformat()
+    now_ms = iso_to_ms(now)
+    user_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM users WHERE id NOT IN (SELECT user_id FROM user_state)"
+    )]
+    conn.executemany(
+        "INSERT INTO user_state (user_id, points, total_lit_count, streak_count, updated_at) VALUES (?, ?, 0, 0, ?)",
+        [(user_id, INITIAL_POINTS, now) for user_id in user_ids],
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO user_cards (user_id, card_id, status, lit_count, unlocked_at, unlocked_at_ms) VALUES (?, ?, 'unlocked', 0, ?, ?)",
+        [(user_id, card_id, now, now_ms) for user_id in user_ids for card_id in STARTER_CARD_IDS],
+    )
+
+
+def _create_stats_tables(conn):
+    # 全局统计物化表，从现有数据全量构建（包括上一步补建的初始卡）
+    init_stats_tables(conn)
+    rebuild_stats(conn, commit=False)
+
+
+def _add_lit_records_user_ts_index(conn):
+    # 导出与状态接口按时间顺序读取某个用户的全部记录，走索引就不必先在临时 B 树里排序
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_lit_records_user_ts ON lit_records(user_id, timestamp)")
+
+
+MIGRATIONS = [
+    _create_base_tables,
+    _add_unlocked_at_ms,
+    _add_last_lit_ms,
+    _create_refresh_tokens,
+    _backfill_user_state,
+    _create_stats_tables,
+    _add_lit_records_user_ts_index,
+]
+
+
+# ============ 执行器 ============
+
+def _user_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def run_migrations(db_path: str, migrations: list = MIGRATIONS) -> int:
+    """把数据库升级到最新版本，返回执行的步骤数；已是最新时只读一次版本号"""
+    conn = sqlite3.connect(db_path, isolation_level=None, timeout=30)
+    try:
+        target = len(migrations)
+        version = _user_version(conn)
+        if version >= target:
+            if version > target:
+                logger.warning("数据库版本 %d 高于代码中的迁移数 %d", version, target)
+            return 0
+
+        # WAL：读不再阻塞在写事务后面（设置会持久化在库文件里，且不能在事务内修改）
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 拿到写锁后重读：其他 worker 可能刚刚执行完
+            version = _user_version(conn)
+            for step in migrations[version:]:
+                logger.info("执行数据库迁移 %s", step.__name__)
+                step(conn)
+            conn.execute(f"PRAGMA user_version = {max(version, target)}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return max(target - version, 0)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    print(f"执行了 {run_migrations(os.getenv('DB_PATH', 'cloud_collection.db'))} 个迁移步骤")
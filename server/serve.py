@@ -0,0 +1,71 @@
+"""
+多 worker 启动器
+用法：python serve.py --workers 4 [--host 0.0.0.0] [--port 8000]
+
+1. 校验共享配置（必须设置 JWT_SECRET，多 worker 共用同一个密钥）
+2. 多 worker 时拉起本机共享状态服务（Unix socket），并通过环境变量告知各 worker
+3. 在父进程中执行一次数据库迁移，再交给 uvicorn 启动 worker（worker 是新进程，各自导入 main:app）
+"""
+
+import os
+import sys
+import argparse
+
+from dotenv import load_dotenv
+
+from shared_state import default_address, derive_authkey, start_state_server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Cloud Collection 多 worker 启动器")
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", "1")))
+    parser.add_argument("--state-addr", default=os.getenv("SHARED_STATE_ADDR", ""),
+                        help="共享状态服务的 socket 路径（默认放在临时目录）")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    load_dotenv()
+    args = parse_args(argv)
+
+    secret = os.getenv("JWT_SECRET", "")
+    if not secret and (args.workers > 1 or os.getenv("ALLOW_EPHEMERAL_JWT_SECRET", "") != "1"):
+        sys.exit("必须设置 JWT_SECRET（写入 .env 或环境变量）；多 worker 部署必须共用同一个密钥")
+
+    os.environ["WEB_CONCURRENCY"] = str(args.workers)
+
+    manager = None
+    if args.workers > 1 and os.getenv("SHARED_STATE_BACKEND", "socket") == "socket":
+        address = args.state_addr or default_address()
+        manager = start_state_server(address, derive_authkey(secret))
+        os.environ["SHARED_STATE_BACKEND"] = "socket"
+        os.environ["SHARED_STATE_ADDR"] = address
+
+    # 父进程只跑迁移，不导入 main（其中的线程、连接与缓存 worker 用不上）；
+    # worker 启动时读到 user_version 已是最新，直接跳过
+    import uvicorn
+    from migrations import run_migrations
+
+    applied = run_migrations(os.getenv("DB_PATH", "cloud_collection.db"))
+    if applied:
+        print(f"数据库迁移完成，执行了 {applied} 步")
+
+    try:
+        uvicorn.run(
+            "main:app",
+            host=args.host,
+            port=args.port,
+            workers=args.workers,
+            app_dir=os.path.dirname(os.path.abspath(__file__)),
+        )
+    finally:
+        if manager is not None:
+            manager.shutdown()
+            if os.path.exists(os.environ["SHARED_STATE_ADDR"]):
+                os.unlink(os.environ["SHARED_STATE_ADDR"])
+
+
+if __name__ == "__main__":
+    main()
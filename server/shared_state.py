@@ -0,0 +1,203 @@
+"""
+跨 worker 共享状态
+给缓存、限流计数、single-flight 锁提供统一接口：
+- memory：进程内字典（单 worker 默认）
+- socket：由启动器（serve.py）拉起的本机状态服务，worker 通过 Unix socket 访问
+协程里通过 AsyncState 访问：socket 代理调用是阻塞的 IPC，放到专用线程执行，
+状态服务卡住或退出时降级（缓存按未命中处理、跳过 single-flight），不影响请求本身
+"""
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.managers import BaseManager
+from typing import Any, Optional
+
+logger = logging.getLogger("cloud_collection.shared_state")
+
+
+class MemoryState:
+    """进程内实现，所有操作线程安全，过期键在访问时惰性清理"""
+
+    def __init__(self):
+        self._data = {}  # key -> (value, expires_at 或 None)
+        self._lock = threading.Lock()
+
+    def _live(self, key: str, now: float):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            item = self._live(key, time.monotonic())
+            return default if item is None else item[0]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            expires_at = time.monotonic() + ttl if ttl else None
+            self._data[key] = (value, expires_at)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """键不存在时写入并返回 True（用作 single-flight / 分布式锁）"""
+        with self._lock:
+            now = time.monotonic()
+            if self._live(key, now) is not None:
+                return False
+            self._data[key] = (value, now + ttl if ttl else None)
+            return True
+
+    def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """计数器自增，ttl 只在键新建时生效（固定窗口限流）"""
+        with self._lock:
+            now = time.monotonic()
+            item = self._live(key, now)
+            if item is None:
+                value, expires_at = amount, (now + ttl if ttl else None)
+            else:
+                value, expires_at = item[0] + amount, item[1]
+            self._data[key] = (value, expires_at)
+            return value
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+# ============ 本机共享实现 ============
+
+_server_store = None
+
+
+def _get_server_store() -> MemoryState:
+    global _server_store
+    if _server_store is None:
+        _server_store = MemoryState()
+    return _server_store
+
+
+class StateManager(BaseManager):
+    pass
+
+
+StateManager.register(
+    "state", callable=_get_server_store,
+    exposed=("get", "set", "add", "incr", "delete", "clear"),
+)
+
+
+def derive_authkey(secret: str) -> bytes:
+    return hashlib.sha256(b"cloud-collection-shared-state:" + secret.encode()).digest()
+
+
+def default_address() -> str:
+    return os.path.join(tempfile.gettempdir(), f"cloud-collection-state-{os.getpid()}.sock")
+
+
+def start_state_server(address: str, authkey: bytes) -> StateManager:
+    """在子进程中启动状态服务（由启动器调用，worker 退出后仍然保留数据）"""
+    if os.path.exists(address):
+        os.unlink(address)
+    manager = StateManager(address=address, authkey=authkey)
+    manager.start()
+    return manager
+
+
+def connect_socket_state(address: str, authkey: bytes):
+    """连接启动器拉起的状态服务，返回与 MemoryState 同接口的代理"""
+    manager = StateManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.state()
+
+
+def create_shared_state(backend: str, address: str = "", secret: str = ""):
+    if backend == "memory":
+        return MemoryState()
+    if backend == "socket":
+        if not address:
+            raise RuntimeError("SHARED_STATE_BACKEND=socket 需要同时设置 SHARED_STATE_ADDR")
+        return connect_socket_state(address, derive_authkey(secret))
+    raise RuntimeError(f"未知的 SHARED_STATE_BACKEND: {backend}")
+
+
+# ============ 协程接口 ============
+
+class AsyncState:
+    """共享状态的异步包装。offload=False（进程内实现）时直接调用；
+    否则在专用线程中调用，超时或出错后 retry_after 秒内直接返回降级值，不再等待状态服务"""
+
+    def __init__(self, state, offload: bool = True, timeout: float = 0.5,
+                 retry_after: float = 5.0, max_workers: int = 4):
+        self._state = state
+        self._executor = (
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="shared-state") if offload else None
+        )
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._down_until = 0.0
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        return await self._call("get", (key, default), fallback=default)
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self._call("set", (key, value, ttl))
+
+    async def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        # 状态服务不可用时放行，相当于不做 single-flight
+        return await self._call("add", (key, value, ttl), fallback=True)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        return await self._call("incr", (key, amount, ttl), fallback=amount)
+
+    async def delete(self, key: str) -> None:
+        await self._call("delete", (key,))
+
+    async def clear(self) -> None:
+        await self._call("clear", ())
+
+    async def _call(self, method: str, args: tuple, fallback: Any = None) -> Any:
+        if self._executor is None:
+            return getattr(self._state, method)(*args)
+        if time.monotonic() < self._down_until:
+            return fallback
+        loop = asyncio.get_running_loop()
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._executor, self._invoke, method, args), self.timeout
+            )
+        except Exception as exc:
+            self._down_until = time.monotonic() + self.retry_after
+            logger.warning("共享状态服务不可用（%r），%.0f 秒内降级处理", exc, self.retry_after)
+            return fallback
+
+    def _invoke(self, method: str, args: tuple) -> Any:
+        try:
+            return getattr(self._state, method)(*args)
+        except Exception:
+            # 代理的连接是线程私有的；断开后丢弃，下次调用时重新连接
+            tls = getattr(self._state, "_tls", None)
+            conn = getattr(tls, "connection", None)
+            if conn is not None:
+                try:
+                    conn.close()
+                except OSError:
+                    pass
+                del tls.connection
+            raise
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
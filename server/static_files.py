@@ -0,0 +1,198 @@
+"""
+前端静态文件托管
+启动时扫描一次 STATIC_DIR 建立内存清单：小文件连同 br/gzip 预压缩版本常驻内存，
+大文件只记录 stat 信息、由 FileResponse 从磁盘分块读取发送（uvicorn 下不是 sendfile 零拷贝；
+只有实现了 http.response.pathsend 扩展的服务器才会把文件路径直接交给服务器发送）。
+请求阶段只查字典，ETag 命中直接 304，不访问磁盘
+
+br/gzip 版本应在部署时生成（deploy.sh 会执行）：python static_files.py static/
+启动时只在缺少预压缩文件时用较低的压缩级别临时生成，避免拖慢每个 worker 的启动
+"""
+
+import os
+import sys
+import gzip
+import hashlib
+import mimetypes
+from typing import Optional
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+
+from compression import brotli, is_compressible, negotiate_encoding
+
+# Vite 打包产物带内容哈希，可以永久缓存
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# index.html 必须每次回源校验，才能拿到新版本的入口
+REVALIDATE_CACHE = "no-cache"
+# 其他不带哈希的公共资源（图片等）
+DEFAULT_CACHE = "public, max-age=86400"
+
+PRECOMPRESS_MIN_BYTES = 1024
+# 部署时离线生成用最高压缩级别；启动时临时生成只用低级别（brotli 11 每 MB 要数秒）
+BUILD_LEVELS = {"br": 11, "gzip": 9}
+STARTUP_LEVELS = {"br": 4, "gzip": 6}
+ENCODING_SUFFIXES = (("br", ".br"), ("gzip", ".gz"))
+
+
+class StaticEntry:
+    __slots__ = ("path", "stat", "media_type", "etag", "cache_control", "body", "variants")
+
+    def __init__(self, path: str, stat: os.stat_result, media_type: str, etag: str,
+                 cache_control: str, body: Optional[bytes], variants: dict):
+        self.path = path
+        self.stat = stat
+        self.media_type = media_type
+        self.etag = etag
+        self.cache_control = cache_control
+        self.body = body          # None 表示大文件，不驻留内存
+        self.variants = variants  # {编码: (压缩后内容, ETag)}
+
+
+def _media_type_for(path: str) -> str:
+    media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if media_type.startswith("text/") or media_type == "application/javascript":
+        media_type += "; charset=utf-8"
+    return media_type
+
+
+def _compress(body: bytes, encoding: str, level: int) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+
+def _file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=12)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _cache_control_for(rel_path: str) -> str:
+    if rel_path.startswith("assets/"):
+        return IMMUTABLE_CACHE
+    if rel_path.endswith(".html"):
+        return REVALIDATE_CACHE
+    return DEFAULT_CACHE
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in candidates or f"W/{etag}" in candidates
+
+
+class StaticManifest:
+    """STATIC_DIR 的内存清单"""
+
+    def __init__(self, root: str, sendfile_min_bytes: int = 1024 * 1024):
+        self.root = root
+        self.sendfile_min_bytes = sendfile_min_bytes
+        self.entries = {}
+        self._build()
+
+    def _build(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                if name.endswith((".br", ".gz")):
+                    continue  # 作为原文件的预压缩版本读取
+                path = os.path.join(dirpath, name)
+                rel_path = os.path.relpath(path, self.root).replace(os.sep, "/")
+                self.entries[rel_path] = self._load(path, rel_path)
+
+    def _load(self, path: str, rel_path: str) -> StaticEntry:
+        stat = os.stat(path)
+        media_type = _media_type_for(path)
+        cache_control = _cache_control_for(rel_path)
+
+        if stat.st_size >= self.sendfile_min_bytes:
+            etag = f'"{_file_digest(path)}"'
+            return StaticEntry(path, stat, media_type, etag, cache_control, None, {})
+
+        with open(path, "rb") as f:
+            body = f.read()
+        digest = hashlib.blake2b(body, digest_size=12).hexdigest()
+
+        variants = {}
+        if len(body) >= PRECOMPRESS_MIN_BYTES and is_compressible(media_type):
+            for encoding, suffix in ENCODING_SUFFIXES:
+                if encoding == "br" and brotli is None:
+                    continue
+                prebuilt = path + suffix
+                if os.path.isfile(prebuilt) and os.path.getmtime(prebuilt) >= stat.st_mtime:
+                    # 部署阶段已经生成好的压缩文件
+                    with open(prebuilt, "rb") as f:
+                        data = f.read()
+                else:
+                    data = _compress(body, encoding, STARTUP_LEVELS[encoding])
+                if len(data) < len(body):
+                    variants[encoding] = (data, f'"{digest}-{encoding}"')
+
+        return StaticEntry(path, stat, media_type, f'"{digest}"', cache_control, body, variants)
+
+    def get(self, rel_path: str) -> Optional[StaticEntry]:
+        return self.entries.get(rel_path)
+
+    def response(self, entry: StaticEntry, request_headers: Headers) -> Response:
+        body, etag, encoding = entry.body, entry.etag, None
+        if entry.variants:
+            encoding = negotiate_encoding(request_headers.get("accept-encoding", ""), tuple(entry.variants))
+            if encoding:
+                body, etag = entry.variants[encoding]
+
+        headers = {"etag": etag, "cache-control": entry.cache_control}
+        if entry.variants:
+            headers["vary"] = "Accept-Encoding"
+
+        if _etag_matches(request_headers.get("if-none-match", ""), etag):
+            return Response(status_code=304, headers=headers)
+
+        if body is None:
+            return FileResponse(entry.path, headers=headers, media_type=entry.media_type,
+                                stat_result=entry.stat)
+
+        if encoding:
+            headers["content-encoding"] = encoding
+        return Response(body, headers=headers, media_type=entry.media_type)
+
+
+def precompress(root: str) -> int:
+    """为 root 下可压缩的文件生成最高级别的 .br / .gz，返回写入的文件数（已是最新的跳过）"""
+    written = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.endswith((".br", ".gz")):
+                continue
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            if stat.st_size < PRECOMPRESS_MIN_BYTES or not is_compressible(_media_type_for(path)):
+                continue
+            body = None
+            for encoding, suffix in ENCODING_SUFFIXES:
+                if encoding == "br" and brotli is None:
+                    continue
+                target = path + suffix
+                if os.path.isfile(target) and os.path.getmtime(target) >= stat.st_mtime:
+                    continue
+                if body is None:
+                    with open(path, "rb") as f:
+                        body = f.read()
+                data = _compress(body, encoding, BUILD_LEVELS[encoding])
+                if len(data) < len(body):
+                    with open(target, "wb") as f:
+                        f.write(data)
+                    written += 1
+    return written
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("用法：python static_files.py <静态文件目录>")
+    if brotli is None:
+        print("未安装 brotli，只生成 .gz", file=sys.stderr)
+    print(f"生成了 {precompress(sys.argv[1])} 个预压缩文件")
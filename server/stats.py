@@ -0,0 +1,279 @@
+"""
+全局统计与排行榜
+物化聚合表在 lit / unlock / 迁移的同一事务内增量维护，读接口不再对 lit_records 做 GROUP BY：
+- card_stats：每张卡的点亮人数与累计点亮次数
+- user_rarity_cards / rarity_stats：每个用户各稀有度持有的卡牌数 → 各稀有度的持有人数
+- 积分排行直接走 user_state(points) 索引
+
+全量重建：python stats.py rebuild
+校验（与全量重算结果比对，不写库）：python stats.py check
+"""
+
+import os
+import sys
+import sqlite3
+from typing import Optional
+
+from card_data import CARD_DATA
+
+# 持有 = 已解锁或已点亮
+HELD_STATUSES = ("unlocked", "lit")
+
+
+def init_stats_tables(conn) -> bool:
+    """建表，返回是否为首次创建（首次创建后需要全量重建一次）"""
+    existed = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'card_stats'"
+    ).fetchone()
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS card_stats (
+            card_id TEXT PRIMARY KEY,
+            holders INTEGER NOT NULL DEFAULT 0,
+            lit_count INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_rarity_cards (
+            user_id INTEGER NOT NULL,
+            rarity TEXT NOT NULL,
+            cards INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, rarity)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rarity_stats (
+            rarity TEXT PRIMARY KEY,
+            holders INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_user_state_points ON user_state(points DESC)")
+    return not existed
+
+
+# ============ 增量维护 ============
+
+def apply_card_change(conn, user_id: int, card_id: str, old_status: Optional[str],
+                      new_status: str, lit_delta: int = 0):
+    """一张卡的状态/点亮次数变化时更新聚合表（在调用方事务内执行，不提交）"""
+    card_info = CARD_DATA.get(card_id)
+    if card_info is None:
+        return  # 迁移导入的未知卡牌不计入统计
+
+    was_lit, is_lit = old_status == "lit", new_status == "lit"
+    if lit_delta or was_lit != is_lit:
+        conn.execute(
+            """INSERT INTO card_stats (card_id, holders, lit_count) VALUES (?, ?, ?)
+               ON CONFLICT(card_id) DO UPDATE SET
+                   holders = holders + excluded.holders,
+                   lit_count = lit_count + excluded.lit_count""",
+            (card_id, int(is_lit) - int(was_lit), lit_delta),
+        )
+
+    was_held, is_held = old_status in HELD_STATUSES, new_status in HELD_STATUSES
+    if was_held == is_held:
+        return
+
+    delta = 1 if is_held else -1
+    rarity = card_info["rarity"]
+    conn.execute(
+        """INSERT INTO user_rarity_cards (user_id, rarity, cards) VALUES (?, ?, ?)
+           ON CONFLICT(user_id, rarity) DO UPDATE SET cards = cards + excluded.cards""",
+        (user_id, rarity, delta),
+    )
+    cards = conn.execute(
+        "SELECT cards FROM user_rarity_cards WHERE user_id = ? AND rarity = ?",
+        (user_id, rarity),
+    ).fetchone()[0]
+    # 该稀有度的第一张 / 最后一张卡才会改变持有人数
+    if (delta == 1 and cards == 1) or (delta == -1 and cards == 0):
+        conn.execute(
+            """INSERT INTO rarity_stats (rarity, holders) VALUES (?, ?)
+               ON CONFLICT(rarity) DO UPDATE SET holders = holders + excluded.holders""",
+            (rarity, delta),
+        )
+
+
+# ============ 全量重建 ============
+
+def rebuild_stats(conn, batch_size: int = 1000, commit: bool = True, attempts: int = 3) -> dict:
+    """全量重算所有聚合表。commit=False 时在调用方已开启的（写）事务内执行。
+    commit=True 时扫描在快照读事务中进行、结果先写入临时表，只有最后替换聚合表时才拿写锁，
+    不会长时间阻塞点亮 / 解锁。快照之后若有并发写入，升级写锁会失败（SQLITE_BUSY_SNAPSHOT），
+    此时重新扫描；重试 attempts 次仍失败则全程持有写锁再做一遍"""
+    if not commit:
+        return _rebuild(conn, batch_size)
+    if conn.in_transaction:
+        conn.commit()
+    for attempt in range(attempts + 1):
+        conn.execute("BEGIN IMMEDIATE" if attempt == attempts else "BEGIN")
+        try:
+            result = _rebuild(conn, batch_size)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as exc:
+            conn.rollback()
+            if attempt == attempts or not getattr(exc, "sqlite_errorname", "").startswith("SQLITE_BUSY"):
+                raise
+
+
+def _rebuild(conn, batch_size: int) -> dict:
+    card_rows, rarity_rows = _compute_into_temp(conn, batch_size)
+
+    # 以下是仅有的写主库的语句：从这里开始持有写锁，直到调用方提交
+    conn.execute("DELETE FROM user_rarity_cards")
+    conn.execute("INSERT INTO user_rarity_cards (user_id, rarity, cards) SELECT user_id, rarity, cards FROM temp.rebuild_user_rarity_cards")
+    conn.execute("DELETE FROM card_stats")
+    conn.executemany("INSERT INTO card_stats (card_id, holders, lit_count) VALUES (?, ?, ?)", card_rows)
+    conn.execute("DELETE FROM rarity_stats")
+    conn.executemany("INSERT INTO rarity_stats (rarity, holders) VALUES (?, ?)", rarity_rows)
+    conn.execute("DROP TABLE temp.rebuild_user_rarity_cards")
+    return {"cards": len(card_rows), "rarities": len(rarity_rows)}
+
+
+def _compute_into_temp(conn, batch_size: int):
+    """按 user_id 顺序流式扫描一遍 user_cards。每个用户各稀有度的卡牌数写入临时表
+    （临时库是连接私有的，写它不占主库写锁），返回 card_stats 与 rarity_stats 的行"""
+    card_holders = {}
+    card_lits = {}
+    rarity_holders = {}
+    pending_rows = []
+
+    def flush_user(user_id, rarity_counts):
+        for rarity, cards in rarity_counts.items():
+            pending_rows.append((user_id, rarity, cards))
+            rarity_holders[rarity] = rarity_holders.get(rarity, 0) + 1
+
+    def write_pending():
+        conn.executemany(
+            "INSERT INTO temp.rebuild_user_rarity_cards (user_id, rarity, cards) VALUES (?, ?, ?)", pending_rows
+        )
+        pending_rows.clear()
+
+    conn.execute("DROP TABLE IF EXISTS temp.rebuild_user_rarity_cards")
+    conn.execute("CREATE TEMP TABLE rebuild_user_rarity_cards (user_id INTEGER, rarity TEXT, cards INTEGER)")
+
+    cursor = conn.execute(
+        "SELECT user_id, card_id, status, lit_count FROM user_cards ORDER BY user_id"
+    )
+    current_user, rarity_counts = None, {}
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for user_id, card_id, status, lit_count in rows:
+            if user_id != current_user:
+                if current_user is not None:
+                    flush_user(current_user, rarity_counts)
+                current_user, rarity_counts = user_id, {}
+            card_info = CARD_DATA.get(card_id)
+            if card_info is None:
+                continue
+            if lit_count:
+                card_lits[card_id] = card_lits.get(card_id, 0) + lit_count
+            if status == "lit":
+                card_holders[card_id] = card_holders.get(card_id, 0) + 1
+            if status in HELD_STATUSES:
+                rarity = card_info["rarity"]
+                rarity_counts[rarity] = rarity_counts.get(rarity, 0) + 1
+        if len(pending_rows) >= batch_size:
+            write_pending()
+    if current_user is not None:
+        flush_user(current_user, rarity_counts)
+    write_pending()
+
+    card_rows = [(cid, card_holders.get(cid, 0), card_lits.get(cid, 0))
+                 for cid in card_lits.keys() | card_holders.keys()]
+    return card_rows, list(rarity_holders.items())
+
+
+def check_stats(conn, batch_size: int = 1000) -> dict:
+    """在一个读事务里重新计算聚合表并与现有内容比对（不写主库），返回各表不一致的行数"""
+    if conn.in_transaction:
+        conn.commit()
+    conn.execute("BEGIN")
+    try:
+        card_rows, rarity_rows = _compute_into_temp(conn, batch_size)
+        mismatches = {
+            "card_stats": _diff_rows(conn, "SELECT card_id, holders, lit_count FROM card_stats", card_rows, 1),
+            "rarity_stats": _diff_rows(conn, "SELECT rarity, holders FROM rarity_stats", rarity_rows, 1),
+            "user_rarity_cards": _diff_rows(
+                conn, "SELECT user_id, rarity, cards FROM user_rarity_cards",
+                conn.execute("SELECT user_id, rarity, cards FROM temp.rebuild_user_rarity_cards").fetchall(), 2,
+            ),
+        }
+    finally:
+        conn.rollback()
+    return mismatches
+
+
+def _diff_rows(conn, sql: str, expected: list, key_len: int) -> int:
+    # 计数全为 0 的行与不存在等价（增量维护会留下 0，全量重建不写）
+    def normalize(rows):
+        return {tuple(row) for row in rows if any(row[key_len:])}
+    return len(normalize(conn.execute(sql).fetchall()) ^ normalize(expected))
+
+
+# ============ 查询 ============
+
+def display_name(email: str) -> str:
+    """排行榜上的公开昵称：只保留邮箱第一个字符，不暴露域名和用户 id"""
+    return f"{email[:1]}***"
+
+
+def query_global_stats(conn, limit: int) -> dict:
+    cards = conn.execute(
+        "SELECT card_id, holders, lit_count FROM card_stats ORDER BY holders DESC, lit_count DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
+    rarities = conn.execute("SELECT rarity, holders FROM rarity_stats").fetchall()
+    return {
+        "topCards": [
+            {"cardId": cid, "holders": holders, "litCount": lit_count}
+            for cid, holders, lit_count in cards
+        ],
+        "rarityHolders": {rarity: holders for rarity, holders in rarities},
+    }
+
+
+def query_leaderboard(conn, limit: int) -> list:
+    rows = conn.execute(
+        """SELECT u.email, s.points FROM user_state s JOIN users u ON u.id = s.user_id
+           ORDER BY s.points DESC, s.user_id LIMIT ?""",
+        (limit,),
+    ).fetchall()
+    board, rank, last_points = [], 0, None
+    for i, (email, points) in enumerate(rows):
+        # 同分同名次，与 query_rank_for_points 的口径一致
+        if points != last_points:
+            rank, last_points = i + 1, points
+        board.append({"rank": rank, "name": display_name(email), "points": points})
+    return board
+
+
+def query_user_points(conn, user_id: int) -> Optional[int]:
+    row = conn.execute("SELECT points FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+    return None if row is None else row[0]
+
+
+def query_rank_for_points(conn, points: int) -> int:
+    """积分为 points 时的名次。COUNT 要扫描索引中分数更高的那一段，代价与名次成正比，
+    所以调用方按分数缓存结果（同分的用户共用一条缓存）"""
+    ahead = conn.execute("SELECT COUNT(*) FROM user_state WHERE points > ?", (points,)).fetchone()[0]
+    return ahead + 1
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    if sys.argv[1:] not in (["rebuild"], ["check"]):
+        sys.exit("用法：python stats.py rebuild | check")
+    conn = sqlite3.connect(os.getenv("DB_PATH", "cloud_collection.db"))
+    init_stats_tables(conn)
+    if sys.argv[1] == "rebuild":
+        print(rebuild_stats(conn))
+    else:
+        mismatches = check_stats(conn)
+        print(mismatches)
+        if any(mismatches.values()):
+            sys.exit(1)
+    conn.close()